@@ -0,0 +1,143 @@
+import subprocess
+import tempfile
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from xml.sax.saxutils import quoteattr
+
+# The admin boundaries of a planet file, held in memory, and the answers an overpass server would give to the
+# post_body, sub_region_query and full_region scripts of countrymaker.py. Kept apart from countrymaker.py, so the
+# answers stay the same while the splitter being benchmarked changes.
+class Boundaries:
+    def __init__(self, nodes, ways, relations):
+        self.nodes = nodes
+        self.ways = ways
+        self.relations = relations
+        self.points = {}
+    @classmethod
+    def load(class_, planetfile):
+        nodes = {}
+        ways = {}
+        relations = {}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            boundaries = Path(tmpdir) / 'boundaries.osm.pbf'
+            subprocess.run(['osmium', 'tags-filter', '-o', str(boundaries), str(planetfile), 'r/boundary=administrative'], check=True)
+            p = subprocess.Popen(['osmium', 'cat', '-f', 'osm', str(boundaries)], stdout=subprocess.PIPE)
+            for _, element in ET.iterparse(p.stdout):
+                if element.tag not in ('node', 'way', 'relation'):
+                    continue
+                id_ = int(element.get('id'))
+                tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+                if element.tag == 'node':
+                    nodes[id_] = (float(element.get('lon')), float(element.get('lat')), tags)
+                elif element.tag == 'way':
+                    ways[id_] = ([int(nd.get('ref')) for nd in element.iter('nd')], tags)
+                elif tags.get('boundary') == 'administrative':
+                    members = [(member.get('type'), int(member.get('ref')), member.get('role')) for member in element.iter('member')]
+                    relations[id_] = (members, tags)
+                element.clear()
+            if p.wait():
+                raise RuntimeError(f'osmium cat {boundaries} returned non-zero code {p.returncode}')
+        return class_(nodes, ways, relations)
+    def admin_relations(self, admin_level):
+        return sorted(id_ for id_, (_, tags) in self.relations.items()
+                      if tags.get('admin_level') == admin_level and tags.get('type') != 'multilinestring')
+    # Closed rings of the relation's member ways, as lists of (lon, lat)
+    def rings(self, id_):
+        members, _ = self.relations.get(id_, ([], {}))
+        open_ = []
+        rings = []
+        for type_, ref, _ in members:
+            if type_ == 'way' and ref in self.ways:
+                nodes = self.ways[ref][0]
+                (rings if nodes[0] == nodes[-1] else open_).append(list(nodes))
+        while open_:
+            ring = open_.pop()
+            while ring[0] != ring[-1]:
+                for i, nodes in enumerate(open_):
+                    if nodes[0] == ring[-1] or nodes[-1] == ring[-1]:
+                        ring += (nodes if nodes[0] == ring[-1] else nodes[::-1])[1:]
+                        del open_[i]
+                        break
+                else:
+                    break
+            if ring[0] == ring[-1]:
+                rings.append(ring)
+        return [[self.nodes[ref][:2] for ref in ring if ref in self.nodes] for ring in rings]
+    # Midpoint of the widest span inside the relation, on the line through the middle of its largest ring
+    def interior_point(self, id_):
+        if id_ not in self.points:
+            self.points[id_] = None
+            rings = self.rings(id_)
+            if rings:
+                largest = max(rings, key=lambda ring: abs(sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(ring, ring[1:]))))
+                ys = [y for _, y in largest]
+                y = (min(ys) + max(ys)) / 2 + 1e-9
+                xs = sorted(x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+                            for ring in rings for (x1, y1), (x2, y2) in zip(ring, ring[1:]) if (y1 > y) != (y2 > y))
+                spans = [(xs[i + 1] - xs[i], i) for i in range(0, len(xs) - 1, 2)]
+                if spans:
+                    _, i = max(spans)
+                    self.points[id_] = ((xs[i] + xs[i + 1]) / 2, y)
+        return self.points[id_]
+    def subregions(self, parent, admin_level):
+        rings = self.rings(parent)
+        result = []
+        for id_ in self.admin_relations(admin_level):
+            point = self.interior_point(id_)
+            if id_ == parent or point is None:
+                continue
+            x, y = point
+            inside = False
+            for ring in rings:
+                for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+                    if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                        inside = not inside
+            if inside:
+                result.append(id_)
+        return result
+    def full_region(self, id_):
+        if id_ not in self.relations:
+            return document('')
+        members, tags = self.relations[id_]
+        wayids = sorted(ref for type_, ref, _ in members if type_ == 'way' and ref in self.ways)
+        nodeids = {ref for type_, ref, _ in members if type_ == 'node'}
+        for ref in wayids:
+            nodeids.update(self.ways[ref][0])
+        body = [node_xml(ref, *self.nodes[ref]) for ref in sorted(nodeids) if ref in self.nodes]
+        body += [way_xml(ref, *self.ways[ref]) for ref in wayids]
+        body.append(relation_xml(id_, *self.relations[id_]))
+        return document(''.join(body))
+    def query(self, body):
+        script = ET.fromstring(body)
+        idquery = script.find('.//id-query')
+        if idquery is not None:
+            return self.full_region(int(idquery.get('ref')))
+        query = script.find('query')
+        conditions = {kv.get('k'): kv.get('v') for kv in query.findall('has-kv')} if query is not None else {}
+        area = query.find('area-query') if query is not None else None
+        if area is not None:
+            ids = self.subregions(int(area.get('ref')) - 3600000000, conditions.get('admin_level'))
+        elif conditions.get('admin_level') == '2':
+            ids = self.admin_relations('2')
+        else:
+            raise ValueError(f'The stand-in cannot answer this query: {body}')
+        return document(''.join(relation_xml(id_, *self.relations[id_]) for id_ in ids))
+
+def tags_xml(tags):
+    return ''.join(f'    <tag k={quoteattr(k)} v={quoteattr(v)}/>\n' for k, v in tags.items())
+
+def node_xml(id_, lon, lat, tags):
+    if not tags:
+        return f'  <node id="{id_}" lat="{lat:.7f}" lon="{lon:.7f}"/>\n'
+    return f'  <node id="{id_}" lat="{lat:.7f}" lon="{lon:.7f}">\n{tags_xml(tags)}  </node>\n'
+
+def way_xml(id_, nodes, tags):
+    nds = ''.join(f'    <nd ref="{ref}"/>\n' for ref in nodes)
+    return f'  <way id="{id_}">\n{nds}{tags_xml(tags)}  </way>\n'
+
+def relation_xml(id_, members, tags):
+    lines = ''.join(f'    <member type="{type_}" ref="{ref}" role={quoteattr(role)}/>\n' for type_, ref, role in members)
+    return f'  <relation id="{id_}">\n{lines}{tags_xml(tags)}  </relation>\n'
+
+def document(body):
+    return f'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="overpass stand-in">\n{body}</osm>\n'
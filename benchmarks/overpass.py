@@ -0,0 +1,69 @@
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+
+from boundaries import Boundaries
+
+# Local HTTP stand-in for an overpass server, answering the post_body, sub_region_query and full_region scripts
+# from the Boundaries of the planet file. latency adds a fixed delay to every request, to mimic a remote server.
+class OverpassHandler(BaseHTTPRequestHandler):
+    def reply(self, code, text, contenttype='text/plain'):
+        body = text.encode('UTF-8')
+        self.send_response(code)
+        self.send_header('Content-Type', f'{contenttype}; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/status'):
+            self.reply(200, f'Connected as: 0\nRate limit: 0\n{self.server.slots} slots available now.\n')
+        else:
+            self.reply(404, 'Not found')
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('UTF-8')
+        # Real clients may also send the script form-encoded
+        if body.startswith('data='):
+            body = parse_qs(body)['data'][0]
+        time.sleep(self.server.latency)
+        try:
+            self.reply(200, self.server.index.query(body), 'application/osm3s+xml')
+        except ValueError as e:
+            self.reply(400, str(e))
+        self.server.requests += 1
+    def log_message(self, format, *args):
+        pass
+
+class OverpassServer(ThreadingHTTPServer):
+    daemon_threads = True
+    def __init__(self, index, port=0, latency=0.0, slots=4):
+        super().__init__(('127.0.0.1', port), OverpassHandler)
+        self.index = index
+        self.latency = latency
+        self.slots = slots
+        self.requests = 0
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/api/interpreter'
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+def serve(planetfile, port=0, latency=0.0):
+    return OverpassServer(Boundaries.load(Path(planetfile)), port, latency).start()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the admin boundaries of a planet file like an overpass server')
+    parser.add_argument('planet', help='Planet file to serve the boundaries of')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before answering each request')
+    args = parser.parse_args()
+    planet = Path(args.planet)
+    server = serve(planet, args.port, args.latency)
+    print(f'Serving {planet} at {server.url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,171 @@
+import argparse
+import json
+import os
+import platform
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from overpass import serve
+from synthetic import generate
+
+# Times the whole pipeline (country split, region splits, shapefiles, coastlines, clipping) on synthetic planets
+# of increasing size, against a local overpass stand-in, and records the results for comparing versions.
+benchdir = Path(__file__).resolve().parent
+repodir = benchdir.parent
+datadir = benchdir / 'data'
+resultsdir = benchdir / 'results'
+
+scenarios = {
+    'small': {'planet': {'countries': 2, 'size': 2.0, 'fanout': 2, 'density': 20000}, 'threshold': 1000000},
+    'medium': {'planet': {'countries': 3, 'size': 3.0, 'fanout': 2, 'density': 40000}, 'threshold': 5000000},
+    'large': {'planet': {'countries': 4, 'size': 4.0, 'fanout': 3, 'density': 40000}, 'threshold': 20000000},
+}
+
+def planet_name(name, params):
+    return f"{name}-" + '-'.join(f'{key}{value}' for key, value in sorted(params.items()))
+
+# Generated once per set of parameters and kept in benchmarks/data, since generating is not what we measure
+def get_planet(name, params):
+    datadir.mkdir(exist_ok=True)
+    planet = datadir / (planet_name(name, params) + '.osm.pbf')
+    if not planet.is_file():
+        print(f'Generating {planet}')
+        generate(planet, **params)
+    return planet
+
+def program_output(*args):
+    try:
+        p = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='UTF-8', cwd=str(repodir))
+    except OSError:
+        return None
+    return p.stdout.strip().split('\n')[0] if p.returncode == 0 else None
+
+def environment():
+    return {
+        'version': program_output('git', 'describe', '--always', '--dirty'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'osmium': program_output('osmium', '--version'),
+        'ogr2ogr': program_output('ogr2ogr', '--version'),
+        'osmcoastline': program_output('osmcoastline', '--version'),
+    }
+
+def count_files(folder, pattern):
+    files = list(folder.glob(pattern))
+    return len(files), sum(f.stat().st_size for f in files)
+
+def run_once(planet, server, threshold, workdir, jobs, extra):
+    if workdir.exists():
+        shutil.rmtree(workdir)
+    workdir.mkdir(parents=True)
+    command = [sys.executable, str(repodir / 'countrymaker.py'),
+               '--workingdir', str(workdir),
+               '--planet-source', str(planet),
+               '--overpass-server', server.url,
+               '--split-treshold', str(threshold),
+               '--shapefile-queries', str(repodir / 'shapefiles.json'),
+               '--generate-shapefiles', 'yes',
+               '--jobs', str(jobs),
+               '--profile'] + extra
+    start = time.time()
+    with open(workdir / 'benchmark.log', 'w', encoding='UTF-8') as log:
+        p = subprocess.run(command, cwd=str(repodir), stdout=log, stderr=subprocess.STDOUT)
+    wall = time.time() - start
+    if p.returncode != 0:
+        raise RuntimeError(f'{" ".join(command)} returned {p.returncode}, see {workdir / "benchmark.log"}')
+    profiles = sorted(workdir.glob('profile-*.json'))
+    profile = json.loads(profiles[-1].read_text()) if profiles else {}
+    cutouts, cutoutbytes = count_files(workdir / 'countrycutouts', '**/*.osm.pbf')
+    shapefiles, shapefilebytes = count_files(workdir / 'shapefiles', '**/*.shp')
+    return {
+        'wall': wall,
+        'stages': {stage['stage']: stage['wall'] for stage in profile.get('stages', [])},
+        'programs': profile.get('summary', {}).get('programs', {}),
+        'overpass': profile.get('summary', {}).get('overpass', {}),
+        'cutouts': cutouts,
+        'cutout_bytes': cutoutbytes,
+        'shapefiles': shapefiles,
+        'shapefile_bytes': shapefilebytes,
+    }
+
+def median_stages(runs):
+    stages = {}
+    for run in runs:
+        for stage, wall in run['stages'].items():
+            stages.setdefault(stage, []).append(wall)
+    return {stage: statistics.median(walls) for stage, walls in stages.items()}
+
+def run_scenario(name, scenario, repeat, jobs, extra, latency, workroot):
+    planet = get_planet(name, scenario['planet'])
+    server = serve(planet, latency=latency)
+    runs = []
+    try:
+        for i in range(repeat):
+            print(f'{name}: run {i + 1}/{repeat}')
+            runs.append(run_once(planet, server, scenario['threshold'], workroot / name, jobs, extra))
+            print(f'{name}: {runs[-1]["wall"]:.1f} s, {runs[-1]["cutouts"]} cutouts, {runs[-1]["shapefiles"]} shapefiles')
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {
+        'planet': scenario['planet'],
+        'planet_bytes': planet.stat().st_size,
+        'threshold': scenario['threshold'],
+        'median_wall': statistics.median(run['wall'] for run in runs),
+        'median_stages': median_stages(runs),
+        'runs': runs,
+    }
+
+def compare(oldfile, newfile):
+    old = json.loads(Path(oldfile).read_text())
+    new = json.loads(Path(newfile).read_text())
+    print(f"{'':30} {old['environment']['version'] or oldfile:>14} {new['environment']['version'] or newfile:>14}   change")
+    for name, newresult in new['scenarios'].items():
+        oldresult = old['scenarios'].get(name)
+        if oldresult is None:
+            continue
+        rows = [('total', oldresult['median_wall'], newresult['median_wall'])]
+        for stage, wall in newresult['median_stages'].items():
+            if stage in oldresult['median_stages']:
+                rows.append((stage, oldresult['median_stages'][stage], wall))
+        print(name)
+        for label, before, after in rows:
+            change = f'{(after - before) / before * 100:+.1f}%' if before else ''
+            print(f'  {label:28} {before:14.2f} {after:14.2f}   {change}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the splitter on synthetic planets, fully offline')
+    parser.add_argument('scenarios', nargs='*', default=['small', 'medium'], help=f'Scenarios to run, out of {", ".join(scenarios)}')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario; the median is reported')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Passed on as --jobs')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the overpass stand-in waits before each answer')
+    parser.add_argument('--countrymaker-args', dest='extra', default='', help='Extra arguments for countrymaker.py, e.g. "--shapefile-export gpkg"')
+    parser.add_argument('--workdir', default=None, help='Where the runs happen; defaults to benchmarks/work')
+    parser.add_argument('--output', default=None, help='Results file; defaults to benchmarks/results/<time>-<version>.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two results files instead of running')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+    env = environment()
+    results = {
+        'environment': env,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'jobs': args.jobs,
+        'latency': args.latency,
+        'countrymaker_args': args.extra,
+        'scenarios': {},
+    }
+    workroot = Path(args.workdir) if args.workdir else benchdir / 'work'
+    for name in args.scenarios:
+        results['scenarios'][name] = run_scenario(name, scenarios[name], args.repeat, args.jobs, shlex.split(args.extra), args.latency, workroot)
+    output = Path(args.output) if args.output else resultsdir / f"{time.strftime('%Y%m%d-%H%M%S')}-{env['version'] or 'unknown'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=1))
+    print(f'Wrote {output}')
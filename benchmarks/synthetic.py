@@ -0,0 +1,155 @@
+import argparse
+import random
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+from xml.sax.saxutils import quoteattr
+
+# Synthetic planet: a grid of square countries, each split into fanout x fanout regions at admin levels 4, 6 and 8,
+# on one island with a coastline around it. The leaf regions are filled with roads, rivers and villages.
+levels = (2, 4, 6, 8)
+
+class Writer:
+    def __init__(self, folder):
+        self.parts = {kind: open(folder / f'{kind}.part', 'w', encoding='UTF-8') for kind in ('node', 'way', 'relation')}
+        self.ids = {kind: 0 for kind in self.parts}
+        self.nodes = 0
+    def next_id(self, kind):
+        self.ids[kind] += 1
+        return self.ids[kind]
+    def tags(self, tags):
+        return ''.join(f'<tag k={quoteattr(k)} v={quoteattr(v)}/>' for k, v in tags.items())
+    def node(self, lon, lat, tags=None):
+        id_ = self.next_id('node')
+        self.nodes += 1
+        if tags:
+            self.parts['node'].write(f'<node id="{id_}" version="1" lat="{lat:.7f}" lon="{lon:.7f}">{self.tags(tags)}</node>\n')
+        else:
+            self.parts['node'].write(f'<node id="{id_}" version="1" lat="{lat:.7f}" lon="{lon:.7f}"/>\n')
+        return id_
+    def way(self, nodes, tags):
+        id_ = self.next_id('way')
+        nds = ''.join(f'<nd ref="{ref}"/>' for ref in nodes)
+        self.parts['way'].write(f'<way id="{id_}" version="1">{nds}{self.tags(tags)}</way>\n')
+        return id_
+    def relation(self, members, tags):
+        id_ = self.next_id('relation')
+        body = ''.join(f'<member type="{type_}" ref="{ref}" role="{role}"/>' for type_, ref, role in members)
+        self.parts['relation'].write(f'<relation id="{id_}" version="1">{body}{self.tags(tags)}</relation>\n')
+        return id_
+    # Nodes, then ways, then relations, as osmium expects
+    def write(self, target):
+        for part in self.parts.values():
+            part.close()
+        with open(target, 'w', encoding='UTF-8') as out:
+            out.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="OSMSplitter benchmarks">\n')
+            for part in self.parts.values():
+                with open(part.name, encoding='UTF-8') as fh:
+                    shutil.copyfileobj(fh, out)
+            out.write('</osm>\n')
+
+# Counter-clockwise ring around the rectangle, with `vertices` points per side
+def rectangle_ring(xmin, ymin, xmax, ymax, vertices):
+    ring = []
+    for i in range(vertices):
+        ring.append((xmin + (xmax - xmin) * i / vertices, ymin))
+    for i in range(vertices):
+        ring.append((xmax, ymin + (ymax - ymin) * i / vertices))
+    for i in range(vertices):
+        ring.append((xmax - (xmax - xmin) * i / vertices, ymax))
+    for i in range(vertices):
+        ring.append((xmin, ymax - (ymax - ymin) * i / vertices))
+    return ring + ring[:1]
+
+def closed_way(writer, ring, tags):
+    nodes = [writer.node(lon, lat) for lon, lat in ring[:-1]]
+    return writer.way(nodes + nodes[:1], tags)
+
+def fill_region(writer, rng, bbox, count):
+    xmin, ymin, xmax, ymax = bbox
+    # Keep features off the boundary so they fall clearly inside one leaf
+    margin = min(xmax - xmin, ymax - ymin) * 0.01
+    def point():
+        return rng.uniform(xmin + margin, xmax - margin), rng.uniform(ymin + margin, ymax - margin)
+    step = (xmax - xmin) / 50
+    while count > 0:
+        kind = rng.random()
+        if kind < 0.1:
+            lon, lat = point()
+            writer.node(lon, lat, {'place': 'village', 'name': f'Village {writer.nodes}'})
+            count -= 1
+            continue
+        length = min(count, rng.randint(5, 40))
+        lon, lat = point()
+        nodes = []
+        for _ in range(length):
+            lon = min(max(lon + rng.uniform(-step, step), xmin + margin), xmax - margin)
+            lat = min(max(lat + rng.uniform(-step, step), ymin + margin), ymax - margin)
+            nodes.append(writer.node(lon, lat))
+        count -= length
+        if len(nodes) < 2:
+            continue
+        if kind < 0.3:
+            tags = {'waterway': 'river', 'name': f'River {writer.ids["way"] + 1}'}
+        else:
+            tags = {'highway': rng.choice(['primary', 'secondary', 'tertiary', 'residential']), 'name': f'Road {writer.ids["way"] + 1}'}
+        writer.way(nodes, tags)
+
+def add_region(writer, rng, bbox, level, name, fanout, density, boundary_vertices):
+    xmin, ymin, xmax, ymax = bbox
+    if level == levels[-1]:
+        fill_region(writer, rng, bbox, int(density * (xmax - xmin) * (ymax - ymin)))
+    else:
+        width = (xmax - xmin) / fanout
+        height = (ymax - ymin) / fanout
+        for i in range(fanout):
+            for j in range(fanout):
+                child = (xmin + i * width, ymin + j * height, xmin + (i + 1) * width, ymin + (j + 1) * height)
+                add_region(writer, rng, child, levels[levels.index(level) + 1], f'{name} {i}{j}', fanout, density, boundary_vertices)
+    way = closed_way(writer, rectangle_ring(*bbox, boundary_vertices), {'boundary': 'administrative', 'admin_level': str(level)})
+    return writer.relation([('way', way, 'outer')], {
+        'type': 'boundary',
+        'boundary': 'administrative',
+        'admin_level': str(level),
+        'name': name,
+        'name:en': name,
+    })
+
+# countries x countries countries of size degrees; density is nodes per square degree inside the leaf regions,
+# scaled per country by a random factor up to skew so that some countries need more splitting than others.
+def generate(target, countries=2, size=4.0, fanout=2, density=10000, skew=4.0, boundary_vertices=50, seed=1):
+    target = Path(target)
+    rng = random.Random(seed)
+    origin = (10.0, 40.0)
+    with tempfile.TemporaryDirectory(dir=str(target.parent)) as tmp:
+        writer = Writer(Path(tmp))
+        for i in range(countries):
+            for j in range(countries):
+                bbox = (origin[0] + i * size, origin[1] + j * size, origin[0] + (i + 1) * size, origin[1] + (j + 1) * size)
+                factor = rng.uniform(1.0, skew)
+                add_region(writer, rng, bbox, levels[0], f'Country {i}{j}', fanout, density * factor, boundary_vertices)
+        extent = countries * size
+        closed_way(writer, rectangle_ring(origin[0] - 1, origin[1] - 1, origin[0] + extent + 1, origin[1] + extent + 1, boundary_vertices),
+                   {'natural': 'coastline'})
+        if target.name.endswith('.osm'):
+            writer.write(target)
+        else:
+            xml = Path(tmp) / 'planet.osm'
+            writer.write(xml)
+            subprocess.run(['osmium', 'cat', '--overwrite', '-o', str(target), str(xml)], check=True)
+    return writer.nodes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic planet file with nested admin boundaries')
+    parser.add_argument('target', help='Output file; .osm is written directly, anything else is converted with osmium')
+    parser.add_argument('--countries', type=int, default=2, help='Number of countries along each side of the grid')
+    parser.add_argument('--size', type=float, default=4.0, help='Size of a country in degrees')
+    parser.add_argument('--fanout', type=int, default=2, help='Each region is split into fanout x fanout regions at the next admin level')
+    parser.add_argument('--density', type=float, default=10000, help='Nodes per square degree inside the regions')
+    parser.add_argument('--skew', type=float, default=4.0, help='Densest country has up to this many times the density')
+    parser.add_argument('--boundary-vertices', dest='boundary_vertices', type=int, default=50, help='Vertices per side of every boundary')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    nodes = generate(args.target, args.countries, args.size, args.fanout, args.density, args.skew, args.boundary_vertices, args.seed)
+    print(f'Wrote {nodes} nodes to {args.target}')
@@ -1,24 +1,95 @@
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
 import xml.etree.ElementTree as ET
 import time
 import math
 from pathlib import Path
 from psutil import virtual_memory
+import psutil
 import json
 import os
 import sys
 import re
+import sqlite3
 import subprocess
+import shutil
+import gzip
 import asyncio
+import numpy as np
+import threading
+import contextlib
+import functools
+import random
+import email.utils
+import socket
+import hashlib
+from datetime import datetime, timezone
+from xml.sax.saxutils import quoteattr
+from concurrent.futures import ThreadPoolExecutor
 
 overpassurl = "https://overpass-api.de/api/interpreter"
 countryosmfile = Path("countries.osm")
+boundaryindexfile = Path("boundaries.sqlite")
+regionindexfile = Path("regions.sqlite")
+journalfile = Path("journal.sqlite")
 osmconffile = Path("osmconf.ini")
 relationsmapfile = Path('mapping.json')
 blacklistfile = Path('blacklist.txt')
+extractplanfile = Path('plan.json')
 coastlinefolder = Path('coastlines')
+continentfolder = Path('continents')
+shapefileintermediate = Path('osm.gpkg')
+# A worker's claim on a queued task expires unless renewed, so the tasks of a dead worker are picked up again
+tasklease = 600.0
+taskattempts = 3
+taskpoll = 5.0
 overpassthrottle = 60.0
+overpassconcurrency = 4
+overpassretries = 6
+overpassretrycodes = (429, 502, 503, 504)
+# Seconds to wait for a connection and for data from it; a stalled request counts as failed and is retried
+overpasstimeout = (30.0, 600.0)
+#The extract tool uses approximately 1-2gb per extract
+osmium_extract_memory = 2000000000
+# Cost model for small extracts: a fixed overhead, plus id sets growing with the output, plus the polygon itself
+extract_memory_base = 100000000
+extract_memory_per_output_byte = 1.0
+extract_memory_per_vertex = 100
+# Rough memory of the other tools, reserved from the same budget as the extracts: osmcoastline holds the coastline
+# ways and their node locations, ogr2ogr's OSM driver indexes the nodes and ways of its input
+coastline_memory = 2000000000
+ogr_memory_base = 200000000
+ogr_memory_per_input_byte = 2.0
+worldbbox = (-180.0, -90.0, 180.0, 90.0)
+# Coarse, overlapping parts of the planet which countries can be extracted from instead of the whole planet.
+# Countries extending beyond all of them, like those with far-off territories, still read the planet.
+continents = {
+    'africa': (-32.0, -56.0, 64.0, 38.5),
+    'antarctica': (-180.0, -90.0, 180.0, -60.0),
+    'asia': (24.0, -12.0, 180.0, 82.0),
+    'australia-oceania': (110.0, -56.0, 180.0, 10.0),
+    'central-america': (-93.0, 5.0, -59.0, 27.0),
+    'europe': (-32.0, 34.0, 69.0, 82.0),
+    'north-america': (-180.0, 5.0, -50.0, 84.0),
+    'south-america': (-93.0, -57.0, -25.0, 14.0),
+}
+presplit = False
+# Extraction polygons are enlarged by twice this many degrees, then simplified within it; 0 extracts with the full relations
+polygontolerance = 0.0005
+densitygridresolution = 0.1
+# Only skip an intermediate level when the prediction is well above the threshold
+density_expand_factor = 2.0
+# Regions without subregions which are above the threshold are cut into quadtree tiles. Tiles are planned to be at most
+# tilefill of the threshold, to leave room for errors in the estimate, with up to tilemaxdepth levels per pass;
+# tiles above the threshold afterwards are cut again, down to tileminsize degrees.
+tilefill = 0.5
+tilemaxdepth = 6
+tileminsize = 0.001
+densitygrid = None
+regionindex = None
+journal = None
+shapefileexport = 'direct'
 
 basepaths = {
     'relation': Path('countryrels'),
@@ -26,6 +97,7 @@ basepaths = {
     'shape': Path('shapefiles/World'),
     'cutout': Path('countrycutouts'),
     'csv': Path('csv'),
+    'polygon': Path('polygons'),
 }
 
 # Get xml containing all relation IDs of countries as root nodes
@@ -68,16 +140,307 @@ filename_end_invalid = re.compile(r'[. ]$')  # Also invalid on Windows
 path_without_ext = re.compile(r"\..*$")
 osmium_error = re.compile(r"While reading file '(?P<filepath>.*?)':")
 coastlines_error = re.compile(r'There were (?P<warnings>\d+) warnings\.\nThere were (?P<errors>\d+) errors\.')
+overpass_slots_available = re.compile(r'^\d+ slots? available now\.$', re.MULTILINE)
+overpass_slot_wait = re.compile(r'in (?P<seconds>-?\d+) seconds\.')
+ogr_progress = re.compile(rb'(\d+)(?:\.\.\.| - done)')
+opl_location = re.compile(rb' x(-?[0-9.]+) y(-?[0-9.]+)$', re.MULTILINE)
 osminfo_extent = re.compile(r'^Extent: \((?P<xmin>.*?), (?P<ymin>.*?)\) - \((?P<xmax>.*?), (?P<ymax>.*?)\)$', re.MULTILINE)
 
 class RetryWithUpdatedBlacklist(RuntimeError):
     pass
 
+# Keeps the estimated memory of concurrently running osmium, osmcoastline and ogr2ogr jobs below a total
+class MemoryBudget:
+    def __init__(self, total):
+        self.total = total
+        self.used = 0
+        self.condition = threading.Condition()
+    def acquire(self, amount):
+        # A job larger than the whole budget gets to run alone
+        amount = min(amount, self.total)
+        with self.condition:
+            self.condition.wait_for(lambda: self.used + amount <= self.total)
+            self.used += amount
+        return amount
+    def release(self, amount):
+        with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
+    @contextlib.contextmanager
+    def reserve(self, amount):
+        amount = self.acquire(amount)
+        try:
+            yield
+        finally:
+            self.release(amount)
+    # For coroutines: waits in a thread, so the other jobs of the event loop keep running
+    @contextlib.asynccontextmanager
+    async def reserve_async(self, amount):
+        amount = await asyncio.get_event_loop().run_in_executor(None, self.acquire, amount)
+        try:
+            yield
+        finally:
+            self.release(amount)
+
+# Runs independent region subtrees concurrently. Tasks may submit further tasks; wait() returns when none are left.
+class RegionScheduler:
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = 0
+        self.errors = []
+        self.condition = threading.Condition()
+    def submit(self, fn, *args):
+        with self.condition:
+            self.pending += 1
+        self.executor.submit(self._run, fn, args)
+    def _run(self, fn, args):
+        try:
+            if not self.errors:
+                fn(*args)
+        except BaseException as e:
+            with self.condition:
+                self.errors.append(e)
+        finally:
+            with self.condition:
+                self.pending -= 1
+                self.condition.notify_all()
+    def wait(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending == 0)
+        self.executor.shutdown()
+        if self.errors:
+            raise self.errors[0]
+
+# Waits for a child process and returns its exit code with its CPU time, peak RSS and I/O. The I/O counters are read
+# once the child has exited but before it is reaped, so they are final; the rest is the kernel's accounting of the
+# child and whatever it waited for, so short runs are measured as exactly as long ones.
+def reap_child(p):
+    os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+    io = {}
+    try:
+        with open(f'/proc/{p.pid}/io') as fh:
+            io = {key: int(value) for key, value in (line.split(':') for line in fh)}
+    except OSError:
+        pass
+    _, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return p.returncode, {
+        'user': rusage.ru_utime,
+        'system': rusage.ru_stime,
+        'peak_rss': rusage.ru_maxrss * 1024,
+        'read_bytes': io.get('rchar'),
+        'write_bytes': io.get('wchar'),
+    }
+
+# reap_child in a thread of its own, as the threads of the default executor may all be waiting for memory
+def reap_child_async(p):
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    def reap():
+        result = reap_child(p)
+        loop.call_soon_threadsafe(lambda: future.cancelled() or future.set_result(result))
+    threading.Thread(target=reap, daemon=True).start()
+    return future
+
+def process_record(args, wall, returncode, usage, info):
+    record = {
+        'program': args[0],
+        'args': [str(arg) for arg in args],
+        'returncode': returncode,
+        'wall': wall,
+        **usage,
+    }
+    record.update(info or {})
+    return record
+
+# Collects where time and memory go during a run, for --profile
+class Profiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stage_name = None
+        self.stages = []
+        self.processes = []
+        self.overpass = []
+    @contextlib.contextmanager
+    def stage(self, name):
+        self.stage_name = name
+        start = time.time()
+        before = os.times()
+        try:
+            yield
+        finally:
+            after = os.times()
+            self.stages.append({
+                'stage': name,
+                'wall': time.time() - start,
+                'user': after.user - before.user,
+                'system': after.system - before.system,
+                'children_user': after.children_user - before.children_user,
+                'children_system': after.children_system - before.children_system,
+                'rss': psutil.Process().memory_info().rss,
+            })
+            self.stage_name = None
+    def add(self, kind, record):
+        record['stage'] = self.stage_name
+        with self.lock:
+            getattr(self, kind).append(record)
+    def run(self, args, info):
+        start = time.time()
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='UTF-8')
+        with p.stdout:
+            stdout = p.stdout.read()
+        returncode, usage = reap_child(p)
+        self.add('processes', process_record(args, time.time() - start, returncode, usage, info))
+        return subprocess.CompletedProcess(args, returncode, stdout, None)
+    # The child is started with Popen rather than asyncio, which would reap it without its resource usage
+    async def run_async(self, args, onoutput):
+        start = time.time()
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        reader = asyncio.StreamReader()
+        transport, _ = await asyncio.get_event_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), p.stdout)
+        try:
+            stdout = await read_output_async(reader, onoutput)
+            returncode, usage = await reap_child_async(p)
+        except asyncio.CancelledError:
+            p.kill()
+            raise
+        finally:
+            transport.close()
+        self.add('processes', process_record(args, time.time() - start, returncode, usage, None))
+        return subprocess.CompletedProcess(args, returncode, stdout, None)
+    def summary(self):
+        programs = {}
+        for record in self.processes:
+            total = programs.setdefault(record['program'], {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0, 'read_bytes': 0, 'write_bytes': 0})
+            total['count'] += 1
+            total['wall'] += record['wall']
+            total['cpu'] += (record['user'] or 0) + (record['system'] or 0)
+            total['peak_rss'] = max(total['peak_rss'], record['peak_rss'])
+            total['read_bytes'] += record['read_bytes'] or 0
+            total['write_bytes'] += record['write_bytes'] or 0
+        latencies = [record['latency'] for record in self.overpass]
+        overpass = {
+            'requests': len(self.overpass),
+            'retries': sum(record['attempts'] - 1 for record in self.overpass),
+            'mean_latency': sum(latencies) / len(latencies) if latencies else None,
+            'max_latency': max(latencies, default=None),
+        }
+        return {'programs': programs, 'overpass': overpass}
+    def write(self, path):
+        report = {
+            'started': datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+            'wall': time.time() - self.started,
+            'argv': sys.argv,
+            'summary': self.summary(),
+            'stages': self.stages,
+            'processes': self.processes,
+            'overpass': self.overpass,
+        }
+        with open(path, 'w', encoding='UTF-8') as fh:
+            json.dump(report, fh, indent=1)
+        print(f"Wrote profile to {path}")
+
+def profile_stage(name):
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name)
+
+memorybudget = MemoryBudget(virtual_memory().total)
+# Polygon simplifications for all regions being planned at the same time, one ogr2ogr per core at most
+simplifier = ThreadPoolExecutor(max_workers=os.cpu_count())
+profiler = None
+blacklistlock = threading.Lock()
+
+# Work queue in an SQLite database on storage shared by all workers, for splitting on several machines.
+# Each task is claimed with a lease which its worker keeps renewing; tasks of a worker which stops renewing
+# are claimed again by another one, up to taskattempts times. A task may require another task to be done first.
+class TaskQueue:
+    schema = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            key TEXT PRIMARY KEY, kind TEXT, args TEXT, priority REAL, requires TEXT,
+            state TEXT DEFAULT 'pending', worker TEXT, lease REAL, attempts INTEGER DEFAULT 0, error TEXT);
+        CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, priority);
+        CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(self.schema)
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+        self.settings = {}
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.db
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+    def seed(self, settings):
+        with self.transaction() as db:
+            db.executemany('INSERT OR REPLACE INTO settings VALUES (?, ?)', [(key, json.dumps(value)) for key, value in settings.items()])
+        self.settings = settings
+    def load_settings(self):
+        with self.lock:
+            self.settings = {key: json.loads(value) for key, value in self.db.execute('SELECT key, value FROM settings')}
+        if not self.settings:
+            raise RuntimeError('The task queue has not been seeded; start one process without --worker first')
+        return self.settings
+    # Adding a task which is already queued (or done) does nothing, so tasks may safely be added again when retried.
+    # With reset, a finished one is queued again, for tasks whose input has been written anew.
+    def put(self, kind, *args, priority=0, requires=None, reset=False):
+        key = ':'.join([kind, *map(str, args)])
+        with self.transaction() as db:
+            db.execute('INSERT OR IGNORE INTO tasks (key, kind, args, priority, requires) VALUES (?, ?, ?, ?, ?)',
+                       (key, kind, json.dumps([str(arg) if isinstance(arg, Path) else arg for arg in args]), priority, requires))
+            if reset:
+                db.execute("UPDATE tasks SET state = 'pending', attempts = 0, error = NULL, priority = ? WHERE key = ? AND state IN ('done', 'failed')",
+                           (priority, key))
+        return key
+    def claim(self):
+        now = time.time()
+        with self.transaction() as db:
+            db.execute("UPDATE tasks SET state = 'failed', error = coalesce(error, 'lease expired') WHERE state = 'running' AND lease < ? AND attempts >= ?",
+                       (now, taskattempts))
+            db.execute("UPDATE tasks SET state = 'failed', error = 'required task failed' WHERE state = 'pending'"
+                       " AND requires IN (SELECT key FROM tasks WHERE state = 'failed')")
+            task = db.execute("SELECT * FROM tasks WHERE (state = 'pending' OR (state = 'running' AND lease < ?))"
+                              " AND (requires IS NULL OR requires IN (SELECT key FROM tasks WHERE state = 'done'))"
+                              " ORDER BY priority DESC LIMIT 1", (now,)).fetchone()
+            if task is None:
+                return None
+            db.execute("UPDATE tasks SET state = 'running', worker = ?, lease = ?, attempts = attempts + 1 WHERE key = ?",
+                       (self.worker, now + tasklease, task['key']))
+        return task
+    def renew(self):
+        with self.transaction() as db:
+            db.execute("UPDATE tasks SET lease = ? WHERE worker = ? AND state = 'running'", (time.time() + tasklease, self.worker))
+    # Only the worker holding the task may finish it; one whose lease was taken over just drops its result
+    def done(self, key):
+        with self.transaction() as db:
+            db.execute("UPDATE tasks SET state = 'done', error = NULL WHERE key = ? AND worker = ? AND state = 'running'", (key, self.worker))
+    def fail(self, key, error):
+        with self.transaction() as db:
+            db.execute("UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ?"
+                       " WHERE key = ? AND worker = ? AND state = 'running'", (taskattempts, error, key, self.worker))
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute('SELECT state, count(*) FROM tasks GROUP BY state').fetchall())
+    def failed(self):
+        with self.lock:
+            return self.db.execute("SELECT key, error FROM tasks WHERE state = 'failed' ORDER BY key").fetchall()
+
 class Multipath:
     @classmethod
     def shapefolders(class_):
         basepath = basepaths['shape']
         for path in sorted(basepath.glob('**/Admins.shp')):
+            if path.parent.name.endswith('.tmp'):
+                continue
             yield class_(path.relative_to(basepath).parent)
     @classmethod
     def cutoutfiles(class_):
@@ -87,8 +450,18 @@ class Multipath:
             yield class_(Path(rel_str))
     def __init__(self, relpath):
         self.relpath = relpath
+    # Tiles are clipped to the polygon of the region they were cut from
     def relation(self):
+        region = regionindex.get(self.relpath)
+        if region is not None and region['tile'] is not None:
+            return Path(region['relation_file'])
         return basepaths['relation'] / (str(self.relpath) + '.osm')
+    # The bbox a tile is clipped to on top of that, or None for regions
+    def tilebbox(self):
+        region = regionindex.get(self.relpath)
+        if region is None or region['tile'] is None:
+            return None
+        return (region['xmin'], region['ymin'], region['xmax'], region['ymax'])
     def shapefolder(self):
         return basepaths['shape'] / self.relpath
     def adminshape(self):
@@ -106,6 +479,168 @@ class Multipath:
     def multipolygons(self):
         return self.csv() / 'multipolygons.csv'
 
+def region_key(relpath):
+    key = str(relpath)
+    return '' if key == '.' else key
+
+# Everything known about the regions of the hierarchy, keyed by their path below countryrels/countrycutouts.
+# Filled while relations are fetched and cutouts are written, so later stages need not parse the .osm files again
+# or run ogrinfo and ogr2ogr to learn a region's extent, geometry or size.
+class RegionIndex:
+    schema = """
+        CREATE TABLE IF NOT EXISTS regions (
+            path TEXT PRIMARY KEY, id INTEGER, name TEXT, name_en TEXT, admin_level TEXT, parent TEXT,
+            relation_file TEXT, cutout_file TEXT, relation_mtime REAL,
+            xmin REAL, ymin REAL, xmax REAL, ymax REAL, vertices INTEGER, problem TEXT, tile TEXT,
+            geometry TEXT, cutout_size INTEGER);
+        CREATE INDEX IF NOT EXISTS regions_parent ON regions (parent);
+        CREATE INDEX IF NOT EXISTS regions_id ON regions (id);
+    """
+    # Columns added since the first version; relation files are inspected again to fill them in
+    addedcolumns = {'problem': 'TEXT', 'tile': 'TEXT', 'geometry': 'TEXT', 'cutout_size': 'INTEGER'}
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        # Workers on other machines may hold the lock for a while
+        self.db = sqlite3.connect(str(path), timeout=60, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(self.schema)
+        columns = {row['name'] for row in self.db.execute("PRAGMA table_info(regions)")}
+        with self.db:
+            for column, type_ in self.addedcolumns.items():
+                if column not in columns:
+                    self.db.execute(f"ALTER TABLE regions ADD COLUMN {column} {type_}")
+                    self.db.execute("UPDATE regions SET relation_mtime = NULL")
+    # Replace the listed children of parent, keeping what is known about the ones which are still there
+    def set_children(self, parent, regions):
+        with self.lock, self.db:
+            paths = [region[0] for region in regions]
+            self.db.execute(f"DELETE FROM regions WHERE parent = ? AND path NOT IN ({','.join('?' * len(paths))})", (parent, *paths))
+            for path, id_, name, name_en, admin_level, parent in regions:
+                relation_file = str(basepaths['relation'] / f'{path}.osm')
+                cutout_file = str(basepaths['cutout'] / f'{path}.osm.pbf')
+                self.db.execute("INSERT OR IGNORE INTO regions (path) VALUES (?)", (path,))
+                self.db.execute("UPDATE regions SET id = ?, name = ?, name_en = ?, admin_level = ?, parent = ?, relation_file = ?, cutout_file = ? WHERE path = ?",
+                                (id_, name, name_en, admin_level, parent, relation_file, cutout_file, path))
+    # Replace the children of parent by its quadtree tiles, given as (path, quadkey, bbox). Tiles have no relation
+    # of their own, they keep the relation file of the region they belong to.
+    def set_tiles(self, parent, tiles):
+        region = self.get(parent)
+        with self.lock, self.db:
+            paths = [tile[0] for tile in tiles]
+            self.db.execute(f"DELETE FROM regions WHERE parent = ? AND path NOT IN ({','.join('?' * len(paths))})", (region['path'], *paths))
+            for path, quadkey, bbox in tiles:
+                cutout_file = str(basepaths['cutout'] / f'{path}.osm.pbf')
+                self.db.execute("INSERT OR IGNORE INTO regions (path) VALUES (?)", (path,))
+                self.db.execute("UPDATE regions SET id = NULL, name = ?, name_en = ?, admin_level = ?, parent = ?, relation_file = ?, cutout_file = ?,"
+                                " xmin = ?, ymin = ?, xmax = ?, ymax = ?, vertices = ?, problem = NULL, tile = ? WHERE path = ?",
+                                (region['name'], region['name_en'], region['admin_level'], region['path'], region['relation_file'], cutout_file,
+                                 *bbox, region['vertices'], quadkey, path))
+    def update_extent(self, path, relationfile):
+        mtime = relationfile.stat().st_mtime
+        region = self.get(path)
+        if region is None or region['relation_mtime'] == mtime:
+            return
+        metadata = relation_metadata(relationfile)
+        if metadata['problem']:
+            print(f"{relationfile} will not be extracted: {metadata['problem']}")
+        with self.lock, self.db:
+            self.db.execute("UPDATE regions SET relation_mtime = ?, xmin = ?, ymin = ?, xmax = ?, ymax = ?, vertices = ?, problem = ?, geometry = ? WHERE path = ?",
+                            (mtime, *(metadata['bbox'] or (None,) * 4), metadata['vertices'], metadata['problem'], metadata['geometry'], path))
+    # The row for path, with the relation inspected first if that has not happened since columns were added
+    def current(self, path):
+        region = self.get(path)
+        if region is not None and region['tile'] is None and region['relation_mtime'] is None and region['relation_file']:
+            relationfile = Path(region['relation_file'])
+            if relationfile.is_file():
+                self.update_extent(region['path'], relationfile)
+                region = self.get(path)
+        return region
+    def set_cutout_size(self, path, size):
+        with self.lock, self.db:
+            self.db.execute("UPDATE regions SET cutout_size = ? WHERE path = ?", (size, region_key(path)))
+    # The size recorded when the cutout was written, or that of the file if there is none
+    def cutout_size(self, path, cutout):
+        region = self.get(path)
+        if region is None or region['cutout_size'] is None:
+            return cutout.stat().st_size
+        return region['cutout_size']
+    # Geometry of the region as WKT; tiles have the one of the region they were cut from
+    def geometry(self, path):
+        region = self.current(path)
+        while region is not None and region['tile'] is not None:
+            region = self.current(region['parent'])
+        return region and region['geometry']
+    def polygon(self, path):
+        geometry = self.geometry(path)
+        return Polygon(wkt_rings(geometry)) if geometry else None
+    def get(self, path):
+        with self.lock:
+            return self.db.execute("SELECT * FROM regions WHERE path = ?", (region_key(path),)).fetchone()
+    def children(self, parent):
+        with self.lock:
+            return self.db.execute("SELECT * FROM regions WHERE parent = ? ORDER BY path", (region_key(parent),)).fetchall()
+    def extent(self, path):
+        region = self.current(path)
+        if region is None or region['xmin'] is None:
+            return None
+        return (region['xmin'], region['ymin'], region['xmax'], region['ymax'])
+
+# Every finished output, with a fingerprint of what it was made from. An output counts as done only if it exists and
+# its inputs, queries and tools are still the same, so a restart redoes exactly the unfinished or outdated work.
+# Outputs are written to temporary paths and renamed when complete, then recorded here.
+class Journal:
+    schema = """
+        CREATE TABLE IF NOT EXISTS outputs (path TEXT PRIMARY KEY, fingerprint TEXT, completed REAL);
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), timeout=60, check_same_thread=False)
+        self.db.executescript(self.schema)
+    def done(self, path, fingerprint):
+        if not Path(path).exists():
+            return False
+        with self.lock:
+            row = self.db.execute("SELECT fingerprint FROM outputs WHERE path = ?", (str(path),)).fetchone()
+        return row is not None and row[0] == fingerprint
+    def record(self, path, fingerprint):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?)", (str(path), fingerprint, time.time()))
+
+def fingerprint(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('UTF-8')).hexdigest()
+
+# Input files are identified by size and modification time; hashing the planet would take longer than most stages
+def file_identity(path):
+    try:
+        stat = Path(path).stat()
+    except FileNotFoundError:
+        return None
+    return [str(path), stat.st_size, stat.st_mtime_ns]
+
+@functools.lru_cache(maxsize=None)
+def tool_version(program):
+    try:
+        p = subprocess.run([program, '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='UTF-8')
+    except OSError:
+        return None
+    return p.stdout.strip().split('\n')[0]
+
+def temporary_path(path):
+    return path.with_name(path.name + '.tmp')
+
+def remove_path(path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        os.remove(path)
+
+# Move a shapefile written elsewhere, with all its side files, over shape, dropping side files (like .qix) of the old one
+def replace_shapefile(tmpshape, shape):
+    for stale in shape.parent.glob(shape.stem + '.*'):
+        os.remove(stale)
+    for part in tmpshape.parent.glob(tmpshape.stem + '.*'):
+        os.replace(part, shape.with_suffix(part.suffix))
+
 def escape_file_name(name):
     result = filename_invalid_characters.sub('', name)
     if filename_invalid.match(result):
@@ -126,31 +661,420 @@ def slurp(fname):
     with open(fname, encoding='UTF-8') as fh:
         return fh.read()
 
+# Join way node lists end to end into closed rings. Returns the rings and the number of ways that could not be closed.
+def assemble_rings(ways):
+    rings = []
+    segments = {}
+    endpoints = {}
+    for i, nodes in enumerate(ways):
+        if len(nodes) < 2:
+            continue
+        if nodes[0] == nodes[-1]:
+            rings.append(list(nodes))
+            continue
+        segments[i] = nodes
+        endpoints.setdefault(nodes[0], set()).add(i)
+        endpoints.setdefault(nodes[-1], set()).add(i)
+    def take(node):
+        candidates = endpoints.get(node)
+        if not candidates:
+            return None
+        i = candidates.pop()
+        nodes = segments.pop(i)
+        other = nodes[-1] if nodes[0] == node else nodes[0]
+        endpoints[other].discard(i)
+        return nodes if nodes[0] == node else nodes[::-1]
+    unclosed = 0
+    while segments:
+        i, nodes = segments.popitem()
+        endpoints[nodes[0]].discard(i)
+        endpoints[nodes[-1]].discard(i)
+        ring = list(nodes)
+        while ring[0] != ring[-1]:
+            following = take(ring[-1])
+            if following is None:
+                break
+            ring.extend(following[1:])
+        if ring[0] == ring[-1]:
+            rings.append(ring)
+        else:
+            unclosed += 1
+    return rings, unclosed
+
+def ring_area(ring):
+    return sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(ring, ring[1:])) / 2
+
+# Polygon of lon/lat rings using the even-odd rule, so inner rings need no special treatment.
+# Edges are bucketed in latitude bands to keep point-in-polygon tests cheap on large boundaries.
+class Polygon:
+    bands = 256
+    def __init__(self, rings):
+        self.rings = [ring for ring in rings if len(ring) >= 4]
+        if not self.rings:
+            self.bbox = None
+            return
+        xs = [x for ring in self.rings for x, _ in ring]
+        ys = [y for ring in self.rings for _, y in ring]
+        self.bbox = (min(xs), min(ys), max(xs), max(ys))
+        self.bandheight = ((self.bbox[3] - self.bbox[1]) / self.bands) or 1.0
+        self.edges = [[] for _ in range(self.bands)]
+        for ring in self.rings:
+            for edge in zip(ring, ring[1:]):
+                (_, y1), (_, y2) = edge
+                for band in range(self.band(min(y1, y2)), self.band(max(y1, y2)) + 1):
+                    self.edges[band].append(edge)
+    def band(self, y):
+        return max(0, min(self.bands - 1, int((y - self.bbox[1]) / self.bandheight)))
+    def contains(self, x, y):
+        if self.bbox is None:
+            return False
+        xmin, ymin, xmax, ymax = self.bbox
+        if not (xmin <= x <= xmax and ymin <= y <= ymax):
+            return False
+        inside = False
+        for (x1, y1), (x2, y2) in self.edges[self.band(y)]:
+            if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+        return inside
+    def crossings(self, y):
+        result = []
+        for (x1, y1), (x2, y2) in self.edges[self.band(y)]:
+            if (y1 > y) != (y2 > y):
+                result.append(x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+        return sorted(result)
+    # A point guaranteed to be inside, taken from the widest span across the middle of the largest ring
+    def interior_point(self):
+        if self.bbox is None:
+            return None
+        ring = max(self.rings, key=lambda ring: abs(ring_area(ring)))
+        ys = [y for _, y in ring]
+        y = (min(ys) + max(ys)) / 2 + 1e-9
+        xs = self.crossings(y)
+        spans = [(xs[i + 1] - xs[i], i) for i in range(0, len(xs) - 1, 2)]
+        if not spans:
+            return None
+        _, i = max(spans)
+        return ((xs[i] + xs[i + 1]) / 2, y)
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+# Pooled connections to one overpass server, with at most `concurrency` requests in flight
+class OverpassClient:
+    def __init__(self, url, concurrency, retries):
+        self.url = url
+        self.statusurl = re.sub(r'interpreter/?$', 'status', url)
+        self.retries = retries
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+    def query(self, body):
+        start = time.time()
+        for attempt in range(self.retries + 1):
+            response = None
+            with self.slots:
+                try:
+                    response = self.session.post(self.url, data=body.encode('UTF-8'), timeout=overpasstimeout)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    if attempt == self.retries:
+                        raise
+                    print(f'Overpass request to {self.url} failed: {e}')
+            if response is not None and response.status_code not in overpassretrycodes:
+                break
+            if attempt == self.retries:
+                break
+            delay = self.retry_delay(response, attempt)
+            print(f'Overpass server is busy; trying again in {delay:.0f} seconds')
+            time.sleep(delay)
+        if profiler is not None:
+            profiler.add('overpass', {
+                'url': self.url,
+                'latency': time.time() - start,
+                'attempts': attempt + 1,
+                'status': response.status_code if response is not None else None,
+                'bytes': len(response.content) if response is not None else 0,
+            })
+        response.raise_for_status()
+        response.encoding = 'UTF-8'
+        return response.text
+    def retry_delay(self, response, attempt):
+        # Exponential backoff with jitter, unless the server tells us how long to wait
+        delay = min(overpassthrottle, 2 ** attempt) * random.uniform(0.5, 1.0)
+        if response is None:
+            return delay
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        if retry_after is None and response.status_code == 429:
+            retry_after = self.slot_wait()
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+    # Seconds until the server's /api/status reports a free slot for us, or None if unknown
+    def slot_wait(self):
+        try:
+            status = self.session.get(self.statusurl, timeout=overpasstimeout)
+            status.raise_for_status()
+        except requests.RequestException:
+            return None
+        if overpass_slots_available.search(status.text):
+            return 0.0
+        waits = [int(m['seconds']) for m in overpass_slot_wait.finditer(status.text)]
+        if not waits:
+            return None
+        return float(max(0, min(waits)))
+
+overpassclients = {}
+overpassclientlock = threading.Lock()
+
+def get_overpass_client(url):
+    with overpassclientlock:
+        if url not in overpassclients:
+            overpassclients[url] = OverpassClient(url, overpassconcurrency, overpassretries)
+        return overpassclients[url]
+
 # Get all top level relation nodes from overpass, based on body
 def make_overpass_request(url, body):
     print(body)
     print(f'Making overpass request to {url}')
-    for _ in range(3):
-        response = requests.post(url=overpassurl, data=body)
-        if response.status_code != 429:  # 429: Too many requests
-            break
-        print(f'Too many requests; trying again in {overpassthrottle} seconds')
-        time.sleep(overpassthrottle)
-    response.raise_for_status()
-    response.encoding = 'UTF-8'
-    return response.text
+    return get_overpass_client(url).query(body)
+
+def osm_tags_xml(tags, indent):
+    return ''.join(f'{indent}<tag k={quoteattr(k)} v={quoteattr(v)}/>\n' for k, v in tags.items())
+
+def osm_node_xml(id_, lon, lat, tags):
+    if not tags:
+        return f'  <node id="{id_}" lat="{lat:.7f}" lon="{lon:.7f}"/>\n'
+    return f'  <node id="{id_}" lat="{lat:.7f}" lon="{lon:.7f}">\n{osm_tags_xml(tags, "    ")}  </node>\n'
+
+def osm_way_xml(id_, nodes, tags):
+    nds = ''.join(f'    <nd ref="{ref}"/>\n' for ref in nodes)
+    return f'  <way id="{id_}">\n{nds}{osm_tags_xml(tags, "    ")}  </way>\n'
+
+def osm_relation_xml(id_, members, tags):
+    lines = ''.join(f'    <member type="{type_}" ref="{ref}" role={quoteattr(role)}/>\n' for type_, ref, role in members)
+    return f'  <relation id="{id_}">\n{lines}{osm_tags_xml(tags, "    ")}  </relation>\n'
+
+def osm_document(body):
+    return f'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="OSMSplitter">\n{body}</osm>\n'
+
+def _chunked_query(db, sql, ids):
+    # Stay below SQLite's limit on bound parameters
+    ids = list(ids)
+    for i in range(0, len(ids), 900):
+        chunk = ids[i:i + 900]
+        yield from db.execute(sql.format(','.join('?' * len(chunk))), chunk)
+
+# Local stand-in for overpass: all boundary=administrative relations of the planet file, with their members,
+# in an SQLite database. Answers the post_body, sub_region_query and full_region scripts.
+class BoundaryIndex:
+    schema = """
+        CREATE TABLE relations (id INTEGER PRIMARY KEY, admin_level TEXT, type TEXT, tags TEXT);
+        CREATE TABLE members (relation INTEGER, seq INTEGER, type TEXT, ref INTEGER, role TEXT);
+        CREATE TABLE ways (id INTEGER PRIMARY KEY, nodes TEXT, tags TEXT);
+        CREATE TABLE nodes (id INTEGER PRIMARY KEY, lon REAL, lat REAL, tags TEXT);
+        CREATE TABLE points (id INTEGER PRIMARY KEY, x REAL, y REAL);
+    """
+    indexes = """
+        CREATE INDEX members_relation ON members (relation, seq);
+        CREATE INDEX relations_admin_level ON relations (admin_level);
+        CREATE TABLE waybboxes AS
+            SELECT w.id AS id, min(n.lon) AS xmin, min(n.lat) AS ymin, max(n.lon) AS xmax, max(n.lat) AS ymax
+            FROM ways w, json_each(w.nodes) j JOIN nodes n ON n.id = j.value GROUP BY w.id;
+        CREATE TABLE bboxes AS
+            SELECT m.relation AS id, min(b.xmin) AS xmin, min(b.ymin) AS ymin, max(b.xmax) AS xmax, max(b.ymax) AS ymax
+            FROM members m JOIN waybboxes b ON b.id = m.ref WHERE m.type = 'way' GROUP BY m.relation;
+        CREATE UNIQUE INDEX bboxes_id ON bboxes (id);
+        DROP TABLE waybboxes;
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Workers on other machines may hold the lock for a while
+        self.db = sqlite3.connect(str(path), timeout=60, check_same_thread=False)
+        self.parentpolygon = (None, None)
+    @classmethod
+    def load(class_, path, planetfile):
+        if not path.is_file() or path.stat().st_mtime < planetfile.stat().st_mtime:
+            class_.build(path, planetfile)
+        return class_(path)
+    # One pass over the planet to cut out the boundaries, then stream them into the database
+    @staticmethod
+    def build(path, planetfile):
+        boundaries = path.with_suffix('.osm.pbf')
+        print(f"Building boundary index {path} from {planetfile}")
+        run_external_program('osmium', 'tags-filter', '--overwrite', '-o', str(boundaries), str(planetfile), 'r/boundary=administrative')
+        tmppath = path.with_suffix('.tmp')
+        if tmppath.exists():
+            os.remove(tmppath)
+        db = sqlite3.connect(str(tmppath))
+        db.executescript(BoundaryIndex.schema)
+        rows = {'node': [], 'way': [], 'relation': [], 'member': []}
+        inserts = {
+            'node': 'INSERT INTO nodes VALUES (?, ?, ?, ?)',
+            'way': 'INSERT INTO ways VALUES (?, ?, ?)',
+            'relation': 'INSERT INTO relations VALUES (?, ?, ?, ?)',
+            'member': 'INSERT INTO members VALUES (?, ?, ?, ?, ?)',
+        }
+        def flush(kind):
+            db.executemany(inserts[kind], rows[kind])
+            rows[kind].clear()
+        p = subprocess.Popen(['osmium', 'cat', '-f', 'osm', str(boundaries)], stdout=subprocess.PIPE)
+        context = ET.iterparse(p.stdout, events=('start', 'end'))
+        _, root = next(context)
+        for event, element in context:
+            if event != 'end' or element.tag not in ('node', 'way', 'relation'):
+                continue
+            id_ = int(element.get('id'))
+            tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+            if element.tag == 'node':
+                rows['node'].append((id_, float(element.get('lon')), float(element.get('lat')), json.dumps(tags) if tags else None))
+            elif element.tag == 'way':
+                nodes = [int(nd.get('ref')) for nd in element.iter('nd')]
+                rows['way'].append((id_, json.dumps(nodes), json.dumps(tags)))
+            elif tags.get('boundary') == 'administrative':
+                rows['relation'].append((id_, tags.get('admin_level'), tags.get('type'), json.dumps(tags)))
+                for seq, member in enumerate(element.iter('member')):
+                    rows['member'].append((id_, seq, member.get('type'), int(member.get('ref')), member.get('role')))
+            root.clear()
+            for kind in rows:
+                if len(rows[kind]) >= 10000:
+                    flush(kind)
+        for kind in rows:
+            flush(kind)
+        if p.wait():
+            raise RuntimeError(f'osmium cat {boundaries} returned non-zero code {p.returncode}')
+        db.executescript(BoundaryIndex.indexes)
+        db.commit()
+        db.close()
+        os.replace(tmppath, path)
+    def relation(self, id_):
+        row = self.db.execute('SELECT tags FROM relations WHERE id = ?', (id_,)).fetchone()
+        if row is None:
+            return None
+        members = self.db.execute('SELECT type, ref, role FROM members WHERE relation = ? ORDER BY seq', (id_,)).fetchall()
+        return json.loads(row[0]), members
+    def ways(self, ids):
+        return {id_: (json.loads(nodes), json.loads(tags)) for id_, nodes, tags in _chunked_query(self.db, 'SELECT id, nodes, tags FROM ways WHERE id IN ({})', ids)}
+    def nodes(self, ids):
+        return {id_: (lon, lat, json.loads(tags) if tags else {}) for id_, lon, lat, tags in _chunked_query(self.db, 'SELECT id, lon, lat, tags FROM nodes WHERE id IN ({})', ids)}
+    def polygon(self, id_):
+        _, members = self.relation(id_) or ({}, [])
+        ways = self.ways(ref for type_, ref, _ in members if type_ == 'way')
+        rings, _ = assemble_rings([nodes for nodes, _ in ways.values()])
+        coords = self.nodes(ref for ring in rings for ref in ring)
+        return Polygon([[coords[ref][:2] for ref in ring if ref in coords] for ring in rings])
+    def interior_point(self, id_):
+        row = self.db.execute('SELECT x, y FROM points WHERE id = ?', (id_,)).fetchone()
+        if row is not None:
+            return row if row[0] is not None else None
+        point = self.polygon(id_).interior_point() or (None, None)
+        self.db.execute('INSERT OR REPLACE INTO points VALUES (?, ?, ?)', (id_, *point))
+        self.db.commit()
+        return point if point[0] is not None else None
+    def countries(self):
+        return [id_ for id_, in self.db.execute("SELECT id FROM relations WHERE admin_level = '2' AND coalesce(type, '') != 'multilinestring' ORDER BY id")]
+    # Like overpass' area-query: relations of admin_level which lie inside the parent's area
+    def subregions(self, parent, admin_level):
+        # Siblings are usually asked for one after the other, so only the most recent parent is worth keeping
+        if self.parentpolygon[0] != parent:
+            self.parentpolygon = (parent, self.polygon(parent))
+        parentpolygon = self.parentpolygon[1]
+        if parentpolygon.bbox is None:
+            return []
+        xmin, ymin, xmax, ymax = parentpolygon.bbox
+        candidates = [id_ for id_, in self.db.execute(
+            "SELECT r.id FROM relations r JOIN bboxes b ON b.id = r.id WHERE r.admin_level = ? AND coalesce(r.type, '') != 'multilinestring'"
+            " AND b.xmax >= ? AND b.xmin <= ? AND b.ymax >= ? AND b.ymin <= ? ORDER BY r.id",
+            (admin_level, xmin, xmax, ymin, ymax))]
+        result = []
+        for id_ in candidates:
+            if id_ == parent:
+                continue
+            point = self.interior_point(id_)
+            if point and parentpolygon.contains(*point):
+                result.append(id_)
+        return result
+    def relations_xml(self, ids):
+        body = []
+        for id_ in ids:
+            tags, members = self.relation(id_)
+            body.append(osm_relation_xml(id_, members, tags))
+        return osm_document(''.join(body))
+    def full_region_xml(self, id_):
+        relation = self.relation(id_)
+        if relation is None:
+            return osm_document('')
+        tags, members = relation
+        ways = self.ways(ref for type_, ref, _ in members if type_ == 'way')
+        nodeids = {ref for type_, ref, _ in members if type_ == 'node'}
+        for nodes, _ in ways.values():
+            nodeids.update(nodes)
+        nodes = self.nodes(nodeids)
+        body = [osm_node_xml(ref, *nodes[ref]) for ref in sorted(nodes)]
+        body += [osm_way_xml(ref, *ways[ref]) for ref in sorted(ways)]
+        body.append(osm_relation_xml(id_, members, tags))
+        return osm_document(''.join(body))
+    def query(self, body):
+        script = ET.fromstring(body)
+        with self.lock:
+            idquery = script.find('.//id-query')
+            if idquery is not None:
+                return self.full_region_xml(int(idquery.get('ref')))
+            query = script.find('query')
+            conditions = {kv.get('k'): kv.get('v') for kv in query.findall('has-kv')}
+            area = query.find('area-query')
+            if area is None and conditions.get('admin_level') == '2':
+                return self.relations_xml(self.countries())
+            if area is not None:
+                return self.relations_xml(self.subregions(int(area.get('ref')) - 3600000000, conditions.get('admin_level')))
+        raise ValueError(f'The boundary index cannot answer this query: {body}')
+
+class Relation:
+    def __init__(self, id_, tags):
+        self.id = id_
+        self.tags = tags
+
+# Stream the relations out of an .osm file without keeping the document in memory
+def iter_relations(source):
+    for _, element in ET.iterparse(str(source)):
+        if element.tag == 'relation':
+            yield Relation(element.get('id'), {tag.get('k'): tag.get('v') for tag in element.iter('tag')})
+        if element.tag in ('node', 'way', 'relation'):
+            element.clear()
+
+# Offline, the answers depend on the boundary index, which is built again for a new planet
+def relation_source(url):
+    client = overpassclients.get(url)
+    return file_identity(client.path) if isinstance(client, BoundaryIndex) else None
+
+def fetch_relations(url, body, cachefile):
+    key = fingerprint(body, relation_source(url))
+    if journal.done(cachefile, key):
+        return
+    print(f"Fetching {cachefile}")
+    xml = make_overpass_request(url, body)
+    ensure_dir(cachefile.parent)
+    tmppath = temporary_path(cachefile)
+    with open(tmppath, "w", encoding='UTF-8') as fh:
+        fh.write(xml)
+    os.replace(tmppath, cachefile)
+    journal.record(cachefile, key)
 
 def get_relations(url, body, cachefile):
-    if cachefile.is_file():
-        xml = slurp(cachefile)
-    else:
-        xml = make_overpass_request(url, body)
-        ensure_dir(cachefile.parent)
-        with open(cachefile, "w", encoding='UTF-8') as fh:
-            fh.write(xml)
-    document = ET.fromstring(xml)
-    allCountryRelations = document.findall("relation")
-    print(f'Returning {len(allCountryRelations)} subregions for {cachefile}') 
+    fetch_relations(url, body, cachefile)
+    allCountryRelations = list(iter_relations(cachefile))
+    print(f'Returning {len(allCountryRelations)} subregions for {cachefile}')
     return allCountryRelations
 
 # Adjust query to get subregions of region with specified id, and only get regions with specified admin_level
@@ -163,24 +1087,19 @@ def get_subregion_relations(superRelationId, admin_level):
 # Get an .osm xml file from overpass api, containing all relevant information to extract region using osmium
 def get_full_region(id_, filename, relationsFolder):
     filepath = relationsFolder / filename
-    if filepath.exists():
-        return
     os.makedirs(relationsFolder, exist_ok=True)
-    print(f"Fetching full region for id: {id_}, and writing to: {filepath}")
-    return get_relations(overpassurl, full_region.format(refid=id_), filepath)
-
-def getTag(element, tag):
-    targetElem = element.find(f"./tag/[@k='{tag}']")
-    if targetElem is not None:
-        return targetElem.get('v')
-    return None
+    fetch_relations(overpassurl, full_region.format(refid=id_), filepath)
+    regionindex.update_extent(region_key(relationsFolder.relative_to(basepaths['relation']) / stripext(filename, '.osm')), filepath)
 
 def get_full_regions_from_xml(source, relations, relationsFolder):
     mapping = []
+    fetches = []
+    regions = []
+    parent = region_key(relationsFolder.relative_to(basepaths['relation']))
     for relation in relations:
-        id_ = relation.get("id")
-        name = getTag(relation, 'name')
-        englishName = getTag(relation, 'name:en')
+        id_ = relation.id
+        name = relation.tags.get('name')
+        englishName = relation.tags.get('name:en')
         if englishName or name:
             filename = escape_file_name((englishName or name) + '.osm')  # Prefer english name
         else:
@@ -189,31 +1108,61 @@ def get_full_regions_from_xml(source, relations, relationsFolder):
         if name is None:
             print(f"Warning: In XML from {source}, {id_} has no name")
             continue
-        get_full_region(id_, filename, relationsFolder)
+        fetches.append((id_, filename))
+        regions.append((region_key(Path(parent) / stripext(filename, '.osm')), int(id_), name, englishName, relation.tags.get('admin_level'), parent))
+    regionindex.set_children(parent, regions)
+    with ThreadPoolExecutor(max_workers=overpassconcurrency) as executor:
+        list(executor.map(lambda fetch: get_full_region(*fetch, relationsFolder), fetches))
     os.makedirs(relationsFolder, exist_ok=True)
     mapfile = relationsFolder / relationsmapfile
     with open(mapfile, 'w') as fh:
         json.dump(mapping, fh)
 
-def extract_required(fname):
-    with open(fname) as fh:
+def extract_fingerprint(osmfile, extract):
+    area = file_identity(extract['polygon']['file_name']) if 'polygon' in extract else extract['bbox']
+    return fingerprint(file_identity(osmfile), area, 'simple', tool_version('osmium'))
+
+# The batch file's contents, and those of its extracts which are not done
+def pending_extracts(extractfile, osmfile):
+    with open(extractfile) as fh:
         data = json.load(fh)
     basedir = Path(data['directory'])
-    for extract in data['extracts']:
-        outpath = basedir / extract['output']
-        if not outpath.is_file():
-            return True
-    return False
+    return data, [extract for extract in data['extracts'] if not journal.done(basedir / extract['output'], extract_fingerprint(osmfile, extract))]
 
-def run_external_program(*args, onerr=None, quiet=False):
-    p = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='UTF-8')
-    return _process_result(p, onerr, quiet)
+def extract_required(extractfile, osmfile):
+    return bool(pending_extracts(extractfile, osmfile)[1])
 
-async def run_external_program_async(*args, onerr=None, quiet=False):
-    p = await asyncio.create_subprocess_exec(args[0], *args[1:], stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='UTF-8')
-    await p.wait()
+def run_external_program(*args, onerr=None, quiet=False, profileinfo=None):
+    if profiler is None:
+        p = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='UTF-8')
+    else:
+        p = profiler.run(args, profileinfo)
     return _process_result(p, onerr, quiet)
 
+# Output is drained while the program runs, so a chatty program can't fill the pipe and stall
+async def run_external_program_async(*args, onerr=None, quiet=False, onoutput=None):
+    if profiler is not None:
+        return _process_result(await profiler.run_async(args, onoutput), onerr, quiet)
+    p = await asyncio.create_subprocess_exec(args[0], *args[1:], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    try:
+        stdout = await read_output_async(p.stdout, onoutput)
+        await p.wait()
+    except asyncio.CancelledError:
+        p.kill()
+        raise
+    return _process_result(subprocess.CompletedProcess(args, p.returncode, stdout, None), onerr, quiet)
+
+async def read_output_async(stream, onoutput):
+    output = []
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        output.append(chunk)
+        if onoutput:
+            onoutput(chunk)
+    return b''.join(output).decode('UTF-8', errors='replace')
+
 def _process_result(p, onerr, quiet):
     if p.returncode or not quiet:
         print(p.stdout)
@@ -223,112 +1172,535 @@ def _process_result(p, onerr, quiet):
             handled = onerr(p.returncode, p.stdout)
         if not handled:
             sys.stdout.flush()
-            raise RuntimeError(f'The external call "{" ".join(args)}" returned non-zero code {p.returncode}')
+            raise RuntimeError(f'The external call "{" ".join(p.args)}" returned non-zero code {p.returncode}')
     return (p.returncode, p.stdout, p.stderr)
 
+def blacklist_failed_relation(code, stdout):
+    m = osmium_error.search(stdout)
+    if not m:
+        print('Could not auto-add to blacklist because the osmium_error regex didn\'t match.')
+        return False
+    relpath = polygon_relation(m['filepath'])
+    with blacklistlock, open(blacklistfile, 'a', encoding='UTF-8') as fh:
+        fh.write(str(relpath) + '\n')
+    print(f"NOTE: {relpath} auto-added to blacklist. Retrying operation.")
+    raise RetryWithUpdatedBlacklist()
+
 def osmium_extracts(extractsdir, osmfile):
-    def errorHandler(code, stdout):
-        m = osmium_error.search(stdout)
-        if not m:
-            print('Could not auto-add to blacklist because the osmium_error regex didn\'t match.')
-            return False
-        abspath = Path(m['filepath'])
-        relpath = abspath.relative_to(basepaths['relation'].resolve())
-        with open(blacklistfile, 'a', encoding='UTF-8') as fh:
-            fh.write(str(relpath) + '\n')
-        print(f"NOTE: {relpath} auto-added to blacklist. Retrying operation.")
-        raise RetryWithUpdatedBlacklist()
     # Extract countries
     if not extractsdir.is_dir():
         raise ValueError(f"{extractsdir} is not a directory.")
     if not osmfile.is_file():
         raise ValueError(f"{osmfile} does not exist.")
-    extractfiles = sorted([entry for entry in extractsdir.iterdir() if entry.is_file()])
+    plan = extract_plan(extractsdir)
+    extractfiles = sorted(extractsdir.glob('extracts*.json'))
     for extractfile in extractfiles:
-        if not extract_required(extractfile):
+        run_extract_batch(extractfile, batch_source(plan, extractfile, osmfile), batch_memory(plan, extractfile))
+
+# Relations osmium still fails on are blacklisted and dropped from their batch, and only that batch is run again
+def run_extract_batch(extractfile, osmfile, memory):
+    while extract_required(extractfile, osmfile):
+        try:
+            osmium_extract_batch(extractfile, osmfile, memory, blacklist_failed_relation)
+        except RetryWithUpdatedBlacklist:
+            blacklist = read_blacklist()
+            with open(extractfile) as fh:
+                data = json.load(fh)
+            data['extracts'] = [extract for extract in data['extracts']
+                                if 'polygon' not in extract or str(polygon_relation(extract['polygon']['file_name'])) not in blacklist]
+            with open(extractfile, 'w') as fh:
+                json.dump(data, fh)
+
+def extract_plan(extractsdir):
+    planfile = extractsdir / extractplanfile
+    return json.loads(slurp(planfile)) if planfile.is_file() else {}
+
+def batch_memory(plan, extractfile):
+    if extractfile.name in plan:
+        return plan[extractfile.name]['memory']
+    with open(extractfile) as fh:
+        return len(json.load(fh)['extracts']) * osmium_extract_memory
+
+# The file a batch is to be extracted from, which may be a part of osmfile
+def batch_source(plan, extractfile, osmfile):
+    if extractfile.name in plan:
+        return Path(plan[extractfile.name]['source'])
+    return osmfile
+
+# Only the extracts which are not done are run, into temporary files which replace the cutouts once osmium succeeds
+def osmium_extract_batch(extractfile, osmfile, memory, onerr):
+    data, pending = pending_extracts(extractfile, osmfile)
+    basedir = Path(data['directory'])
+    runfile = extractfile.with_name('run-' + extractfile.name)
+    with open(runfile, 'w') as fh:
+        json.dump({'directory': data['directory'], 'extracts': [dict(extract, output=extract['output'] + '.tmp', output_format='pbf') for extract in pending]}, fh)
+    with memorybudget.reserve(memory):
+        print(f"Processing extract {extractfile}")
+        run_external_program("osmium", "extract", "--overwrite", "--strategy", "simple", "-c", str(runfile), str(osmfile), onerr=onerr,
+                             profileinfo={'batch': str(extractfile), 'estimated_memory': memory})
+    for extract in pending:
+        cutout = basedir / extract['output']
+        os.replace(temporary_path(cutout), cutout)
+        journal.record(cutout, extract_fingerprint(osmfile, extract))
+        regionindex.set_cutout_size(stripext(cutout.relative_to(basepaths['cutout']), '.osm.pbf'), cutout.stat().st_size)
+
+# Count the planet's nodes per grid cell, from one streaming pass over the file
+def build_density_grid(planetfile, gridfile):
+    print(f"Building density grid {gridfile} from {planetfile}")
+    rows = int(round(180 / densitygridresolution))
+    cols = int(round(360 / densitygridresolution))
+    counts = np.zeros(rows * cols, dtype=np.int64)
+    p = subprocess.Popen(['osmium', 'cat', '-t', 'node', '-f', 'opl,add_metadata=false', str(planetfile)], stdout=subprocess.PIPE)
+    rest = b''
+    while True:
+        chunk = p.stdout.read(1 << 26)
+        if not chunk:
+            break
+        chunk = rest + chunk
+        end = chunk.rfind(b'\n') + 1
+        rest = chunk[end:]
+        locations = opl_location.findall(chunk, 0, end)
+        if not locations:
             continue
-        print(f"Processing extract {extractfile.name}")
-        run_external_program("osmium", "extract", "--overwrite", "--strategy", "simple", "-c", str(extractfile), str(osmfile), onerr=errorHandler)
+        xy = np.array(locations).astype(np.float64)
+        col = np.clip(((xy[:, 0] + 180) / densitygridresolution).astype(np.int64), 0, cols - 1)
+        row = np.clip(((xy[:, 1] + 90) / densitygridresolution).astype(np.int64), 0, rows - 1)
+        counts += np.bincount(row * cols + col, minlength=rows * cols)
+    if p.wait():
+        raise RuntimeError(f'osmium cat {planetfile} returned non-zero code {p.returncode}')
+    total = max(1, int(counts.sum()))
+    tmpfile = gridfile.with_suffix('.tmp')
+    with open(tmpfile, 'wb') as fh:
+        np.savez_compressed(fh, counts=counts.reshape(rows, cols).astype(np.uint32), resolution=densitygridresolution, bytes_per_node=planetfile.stat().st_size / total,
+                            planet=planet_identity(planetfile))
+    os.replace(tmpfile, gridfile)
+
+# Size and modification time of the planet a grid was built from, to notice when it has been replaced
+def planet_identity(planetfile):
+    stat = planetfile.stat()
+    return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+# Predicts the size of a cutout from the number of planet nodes inside its polygon
+class DensityGrid:
+    def __init__(self, path):
+        with np.load(str(path)) as data:
+            self.counts = data['counts']
+            self.resolution = float(data['resolution'])
+            self.bytes_per_node = float(data['bytes_per_node'])
+            self.planet = str(data['planet']) if 'planet' in data.files else None
+    @classmethod
+    def load(class_, path, planetfile):
+        if path.is_file():
+            grid = class_(path)
+            if grid.planet == planet_identity(planetfile):
+                return grid
+            print(f"{path} was built from a different planet file")
+        build_density_grid(planetfile, path)
+        return class_(path)
+    def cell(self, x, y):
+        rows, cols = self.counts.shape
+        row = min(rows - 1, max(0, int((y + 90) / self.resolution)))
+        col = min(cols - 1, max(0, int((x + 180) / self.resolution)))
+        return row, col
+    def predict(self, polygon):
+        if polygon.bbox is None:
+            return None
+        rows, cols = self.counts.shape
+        _, ymin, _, ymax = polygon.bbox
+        nodes = 0
+        # Sum the cells whose centre lies inside the polygon, one scanline per grid row
+        for row in range(self.cell(0, ymin)[0], self.cell(0, ymax)[0] + 1):
+            xs = polygon.crossings(-90 + (row + 0.5) * self.resolution)
+            for x0, x1 in zip(xs[::2], xs[1::2]):
+                first = max(0, math.ceil((x0 + 180) / self.resolution - 0.5))
+                last = min(cols - 1, math.floor((x1 + 180) / self.resolution - 0.5))
+                if last >= first:
+                    nodes += int(self.counts[row, first:last + 1].sum())
+        if nodes == 0:
+            # Smaller than a cell: take the covered share of the cell it lies in
+            point = polygon.interior_point()
+            if point is None:
+                return None
+            share = min(1.0, max(abs(ring_area(ring)) for ring in polygon.rings) / self.resolution ** 2)
+            nodes = int(self.counts[self.cell(*point)]) * share
+        return nodes * self.bytes_per_node
+    # Planet nodes in the cells bbox overlaps
+    def count(self, bbox):
+        row0, col0 = self.cell(bbox[0], bbox[1])
+        row1, col1 = self.cell(bbox[2], bbox[3])
+        return int(self.counts[row0:row1 + 1, col0:col1 + 1].sum())
+
+# Nodes, ways and member ways of the relation in an .osm file: ({id: (lon, lat)}, {id: [node ids]}, [way ids]).
+# The members are None if there is no relation in the file.
+def parse_relation(relationfile):
+    coords = {}
+    ways = {}
+    members = None
+    for _, element in ET.iterparse(str(relationfile)):
+        if element.tag == 'node':
+            coords[element.get('id')] = (float(element.get('lon')), float(element.get('lat')))
+        elif element.tag == 'way':
+            ways[element.get('id')] = [nd.get('ref') for nd in element.iter('nd')]
+        elif element.tag == 'relation':
+            if members is None:
+                members = [member.get('ref') for member in element.iter('member') if member.get('type') == 'way']
+        else:
+            continue
+        element.clear()
+    return coords, ways, members
+
+# Why osmium could not make a polygon of the relation, or None if it can. Checked when the file is fetched,
+# so a broken relation is left out of the batches instead of failing one of them.
+def relation_problem(coords, ways, members, rings, unclosed):
+    if members is None:
+        return 'no relation'
+    missing = [ref for ref in members if ref not in ways]
+    if missing:
+        return f'{len(missing)} of {len(members)} member ways missing'
+    missing = {ref for ref in members for node in ways[ref] if node not in coords}
+    if missing:
+        return f'{len(missing)} member ways with missing nodes'
+    if unclosed:
+        return f'{unclosed} unclosed rings'
+    if not any(ring_area([coords[node] for node in ring]) for ring in rings):
+        return 'empty geometry'
+    return None
+
+# What the region index keeps about a relation file, from one pass over it: the extent and number of its nodes,
+# what is wrong with it if anything, and otherwise its geometry as WKT
+def relation_metadata(relationfile):
+    try:
+        coords, ways, members = parse_relation(relationfile)
+    except (ET.ParseError, ValueError) as e:
+        return {'bbox': None, 'vertices': 0, 'problem': f'unreadable: {e}', 'geometry': None}
+    bbox = None
+    if coords:
+        xs = [x for x, _ in coords.values()]
+        ys = [y for _, y in coords.values()]
+        bbox = (min(xs), min(ys), max(xs), max(ys))
+    rings, unclosed = assemble_rings([ways[ref] for ref in members or () if ref in ways])
+    problem = relation_problem(coords, ways, members, rings, unclosed)
+    geometry = None if problem else multipolygon_wkt([[coords[node] for node in ring] for ring in rings])
+    return {'bbox': bbox, 'vertices': len(coords), 'problem': problem, 'geometry': geometry}
+
+def ring_contains(ring, x, y):
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+# Rings without roles, as assembled from the member ways, as a multipolygon: a ring inside an odd number of others
+# is a hole in the smallest of them. Rings may share vertices and edges, so containment is tested with a point
+# strictly inside the ring, which lies on the same side of every larger ring as the whole ring does.
+def multipolygon_wkt(rings):
+    bboxes = [(min(x for x, _ in ring), min(y for _, y in ring), max(x for x, _ in ring), max(y for _, y in ring)) for ring in rings]
+    areas = [abs(ring_area(ring)) for ring in rings]
+    polygons = {}
+    holes = []
+    for i, ring in enumerate(rings):
+        candidates = [j for j in range(len(rings)) if j != i and bbox_contains(bboxes[j], bboxes[i]) and areas[j] > areas[i]]
+        point = Polygon([ring]).interior_point() if candidates else None
+        containers = [j for j in candidates if point is not None and ring_contains(rings[j], *point)]
+        if len(containers) % 2:
+            holes.append((min(containers, key=lambda j: areas[j]), ring))
+        else:
+            polygons[i] = [ring]
+    for container, ring in holes:
+        polygons.setdefault(container, [rings[container]]).append(ring)
+    def ring_wkt(ring):
+        return '(' + ', '.join(f'{x:.7f} {y:.7f}' for x, y in ring) + ')'
+    return 'MULTIPOLYGON (' + ', '.join('(' + ', '.join(map(ring_wkt, polygon)) + ')' for polygon in polygons.values()) + ')'
+
+def wkt_rings(wkt):
+    return [[tuple(map(float, point.split())) for point in ring.split(',')] for ring in re.findall(r'\(([^()]*)\)', wkt)]
 
-def create_extraction_json(extractsdir, relationsfolder, cutoutsdir, blacklist):
-    count = 0
-    i = 0
-    extractsfile = extractsdir / "extracts"
-    data = {}
+# Area in square degrees at the equator, so densities are comparable between latitudes
+def bbox_area(bbox):
+    xmin, ymin, xmax, ymax = bbox
+    return (xmax - xmin) * (ymax - ymin) * math.cos(math.radians((ymin + ymax) / 2))
 
+# Width in degrees of the longitudes in xs. Boundaries crossing the antimeridian are split there, so their longitudes
+# lie at both ends of -180..180, and the widest gap between neighbouring longitudes is the part the region leaves out.
+def longitude_width(xs):
+    xs = sorted(xs)
+    return 360 - max([b - a for a, b in zip(xs, xs[1:])] + [xs[0] + 360 - xs[-1]])
+
+# Area of the region's bbox, with the width taken around the antimeridian for regions spanning it
+def region_area(region):
+    xmin, ymin, xmax, ymax = region['xmin'], region['ymin'], region['xmax'], region['ymax']
+    if xmax - xmin > 180:
+        polygon = regionindex.polygon(region['path'])
+        if polygon is not None:
+            xmin, xmax = 0, longitude_width([x for ring in polygon.rings for x, _ in ring])
+    return bbox_area((xmin, ymin, xmax, ymax))
+
+# Rough cost of one extract: bytes written, from the nodes of the density grid inside the region if there is a grid,
+# else from the source's bytes per area, and the memory osmium needs for it
+def estimate_extract(region, density):
+    vertices = region['vertices'] or 0
+    output = 0
+    if vertices:
+        polygon = regionindex.polygon(region['path']) if densitygrid is not None else None
+        output = densitygrid.predict(polygon) if polygon is not None else None
+        if output is None:
+            output = region_area(region) * density
+    memory = extract_memory_base + output * extract_memory_per_output_byte + vertices * extract_memory_per_vertex
+    return {'output': output, 'memory': min(osmium_extract_memory, memory)}
+
+# First-fit decreasing on memory, heaviest batches first
+def plan_batches(estimates, capacity):
+    batches = []
+    for estimate in sorted(estimates, key=lambda estimate: estimate['memory'], reverse=True):
+        for batch in batches:
+            if batch['memory'] + estimate['memory'] <= capacity:
+                break
+        else:
+            batch = {'memory': 0, 'output': 0, 'extracts': []}
+            batches.append(batch)
+        batch['memory'] += estimate['memory']
+        batch['output'] += estimate['output']
+        batch['extracts'].append(estimate['extract'])
+    return sorted(batches, key=lambda batch: batch['output'], reverse=True)
+
+# Polygon for osmium to extract a relation with. Boundaries have many more vertices than needed to decide which
+# nodes belong to a region, and osmium tests every node against every vertex. Buffering by twice the tolerance before
+# simplifying within the tolerance keeps all of the original area inside. Cached below polygons/.
+def extraction_polygon(relationpath):
+    if polygontolerance:
+        target = basepaths['polygon'] / (stripext(relationpath.relative_to(basepaths['relation']), '.osm') + '.geojson')
+        key = fingerprint(file_identity(relationpath), simplify_query(relationpath), tool_version('ogr2ogr'))
+        if not journal.done(target, key):
+            simplify_polygon(relationpath, target)
+            if target.is_file():
+                journal.record(target, key)
+        if target.is_file():
+            return {'file_name': str(target.resolve()), 'file_type': 'geojson'}
+    return {'file_name': str(relationpath.resolve()), 'file_type': 'osm'}
+
+# Only the region's own relation is used: closed boundary ways of enclaves and subarea relations are features of
+# their own, which would fill its holes
+def simplify_query(relationpath):
+    region = regionindex.get(stripext(relationpath.relative_to(basepaths['relation']), '.osm'))
+    condition = f"osm_id = '{region['id']}'" if region is not None and region['id'] is not None else "osm_way_id IS NULL"
+    return (f"SELECT ST_SimplifyPreserveTopology(ST_Buffer(ST_Union(geometry), {2 * polygontolerance}), {polygontolerance}) AS geometry"
+            f" FROM multipolygons WHERE {condition}")
+
+def simplify_polygon(relationpath, target):
+    ensure_dir(target.parent)
+    tmppath = temporary_path(target)
+    remove_path(tmppath)
+    query = simplify_query(relationpath)
+    with memorybudget.reserve(ogr_memory_base + relationpath.stat().st_size * ogr_memory_per_input_byte):
+        retcode, _, _ = run_external_program('ogr2ogr', '-oo', f'CONFIG_FILE={osmconffile}', '-f', 'GeoJSON', '-lco', 'COORDINATE_PRECISION=7',
+                                             '-dialect', 'SQLITE', '-sql', query, str(tmppath), str(relationpath),
+                                             onerr=lambda code, stdout: True, quiet=True)
+    # Relations which do not assemble into a polygon are extracted from the .osm file, where osmium reports them
+    if retcode or not tmppath.is_file() or '"coordinates"' not in slurp(tmppath):
+        print(f"Could not simplify {relationpath}, extracting with the full relation")
+        if tmppath.exists():
+            os.remove(tmppath)
+        if target.exists():
+            os.remove(target)
+        return
+    os.replace(tmppath, target)
+
+# The relation, relative to the relations folder, of a polygon file given to osmium
+def polygon_relation(filename):
+    path = Path(filename)
+    polygonfolder = basepaths['polygon'].resolve()
+    if polygonfolder in path.parents:
+        return Path(stripext(path.relative_to(polygonfolder), '.geojson') + '.osm')
+    return path.relative_to(basepaths['relation'].resolve())
+
+def bbox_contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+# The smallest of the sources which contains the whole region, given as (file, bbox, density) with the full source last
+def region_source(region, sources):
+    if region['xmin'] is not None:
+        bbox = (region['xmin'], region['ymin'], region['xmax'], region['ymax'])
+        for source in sources:
+            if bbox_contains(source[1], bbox):
+                return source
+    return sources[-1]
+
+# Extracts are read from the smallest of sourcefile and the parts of it in parts (a list of (file, bbox)) which contains them
+def create_extraction_json(extractsdir, relationsfolders, cutoutsdir, blacklist, sourcefile, sourcebbox, exclude=frozenset(), parts=()):
     os.makedirs(extractsdir, exist_ok=True)
     os.makedirs(cutoutsdir, exist_ok=True)
-    mem = virtual_memory()
-    twoGig = 2000000000 
-    #The extract tool uses approximately 1-2gb per country
-    batchsize = math.floor(mem.total/twoGig)
-    print(f"batchsize is {batchsize}")
-
-    mapfile = relationsfolder / relationsmapfile
-    with open(mapfile, encoding='UTF-8') as fh:
-        mapping = json.load(fh)
+    capacity = max(osmium_extract_memory, min(memorybudget.total, virtual_memory().available))
+    sources = sorted(parts, key=lambda part: part[0].stat().st_size) + [(sourcefile, sourcebbox)]
+    sources = [(path, bbox, path.stat().st_size / max(bbox_area(bbox), 1e-9)) for path, bbox in sources]
 
     # Clean up existing files because files containing only blacklisted items won't be overwritten.
     for fn in extractsdir.glob(f'extracts*.json'):
         os.remove(fn)
 
     # Create json files which are used to extract countries in batches, reducing time used in loading the planet.pbf file
-    extractlist = []
-    for id_, relationfile, name, name_en in mapping:
-        if name is None:
-            continue
-        if blacklist:
-            relpath = relationsfolder.relative_to(basepaths['relation']) / relationfile
-            if str(relpath) in blacklist:
-                print(f"'{str(relpath)}' is in blacklist, skipping.")
+    # Relations from further folders are nested subregions, written below cutoutsdir in the same pass.
+    estimates = {}
+    extracts = []
+    relationpaths = []
+    for relationsfolder in relationsfolders:
+        subdir = relationsfolder.relative_to(relationsfolders[0])
+        os.makedirs(cutoutsdir / subdir, exist_ok=True)
+        for region in regionindex.children(relationsfolder.relative_to(basepaths['relation'])):
+            relationpath = Path(region['relation_file'])
+            if relationpath in exclude:
                 continue
-        extract = {}
-        extract["output"] = f"{relationfile}.pbf"
-        polygon = {}
-        polygon["file_name"] = str((relationsfolder / relationfile).resolve())
-        polygon["file_type"] = "osm"
+            if region['problem']:
+                print(f"'{relationpath}' is broken ({region['problem']}), skipping.")
+                continue
+            if blacklist:
+                relpath = relationpath.relative_to(basepaths['relation'])
+                if str(relpath) in blacklist:
+                    print(f"'{str(relpath)}' is in blacklist, skipping.")
+                    continue
+            extract = {}
+            extract["output"] = str(subdir / f"{relationpath.name}.pbf")
+            extracts.append(extract)
+            relationpaths.append(relationpath)
+            source, _, density = region_source(region, sources)
+            estimate = estimate_extract(region, density)
+            estimate['extract'] = extract
+            estimates.setdefault(source, []).append(estimate)
+
+    # Simplifying runs one ogr2ogr per new or changed relation, so run those side by side
+    for extract, polygon in zip(extracts, simplifier.map(extraction_polygon, relationpaths)):
         extract['polygon'] = polygon
-        extractlist.append(extract)
-        count += 1
-        if count == batchsize:
-            data['extracts'] = extractlist
+
+    write_extraction_batches(extractsdir, cutoutsdir, [(source, estimates[source]) for source, _, _ in sources if source in estimates], capacity)
+
+# Batches from the same source are numbered consecutively, so they run one after the other
+def write_extraction_batches(extractsdir, cutoutsdir, estimates, capacity):
+    plan = {}
+    for source, sourceestimates in estimates:
+        batches = plan_batches(sourceestimates, capacity)
+        print(f"Planned {len(batches)} batches for {len(sourceestimates)} extracts from {source}")
+        for batch in batches:
+            extractsfile = extractsdir / f"extracts{len(plan):04d}.json"
+            data = {}
+            data['extracts'] = batch['extracts']
             data['directory'] = str(cutoutsdir)
-            with open(f"{extractsfile}{i}.json", "w") as json_file:
+            with open(extractsfile, "w") as json_file:
                 json.dump(data, json_file)
-            i += 1
-            data = {}
-            extractlist = []
-            count = 0
-    if len(extractlist) > 0:
-        data['extracts'] = extractlist
-        data['directory'] = str(cutoutsdir)
-        data['strategy'] = 'simple'
-        with open(f"{extractsfile}{i}.json", "w") as json_file:
-            json.dump(data, json_file)
+            plan[extractsfile.name] = {'memory': batch['memory'], 'source': str(source)}
+    with open(extractsdir / extractplanfile, "w") as json_file:
+        json.dump(plan, json_file)
+
+def tile_relpath(relpath, quadkey):
+    return Path(relpath) / f'tile-{quadkey}'
+
+# Quadrant i of bbox, numbered like quadkeys: 0 and 1 along the top, 2 and 3 along the bottom
+def quadrant(bbox, i):
+    xmin, ymin, xmax, ymax = bbox
+    xmid = (xmin + xmax) / 2
+    ymid = (ymin + ymax) / 2
+    x0, x1 = (xmid, xmax) if i & 1 else (xmin, xmid)
+    y0, y1 = (ymin, ymid) if i & 2 else (ymid, ymax)
+    return (x0, y0, x1, y1)
+
+# Quadtree tiles for a cutout of size bytes covering bbox, as (quadkey, bbox, estimated size). A tile is split as long
+# as its share of size, by the nodes in the density grid or else by area, is above tilefill of the threshold.
+# Quadrants the density grid has no nodes in while their siblings do are left out, as there is nothing to cut.
+def plan_tiles(bbox, size, threshold, prefix=''):
+    def weight(tilebbox):
+        return densitygrid.count(tilebbox) if densitygrid is not None else bbox_area(tilebbox)
+    tiles = []
+    def split(quadkey, tilebbox, estimate):
+        small = min(tilebbox[2] - tilebbox[0], tilebbox[3] - tilebbox[1]) < 2 * tileminsize
+        if len(quadkey) > len(prefix) and (estimate < threshold * tilefill or len(quadkey) - len(prefix) >= tilemaxdepth or small):
+            tiles.append((quadkey, tilebbox, estimate))
+            return
+        quadrants = [quadrant(tilebbox, i) for i in range(4)]
+        weights = [weight(quadrantbbox) for quadrantbbox in quadrants]
+        total = sum(weights)
+        for i, (quadrantbbox, quadrantweight) in enumerate(zip(quadrants, weights)):
+            if total and not quadrantweight:
+                continue
+            split(quadkey + str(i), quadrantbbox, estimate * quadrantweight / total if total else estimate / 4)
+    split(prefix, bbox, size)
+    return tiles
+
+# The tiles of a region are cut from its cutout as bbox extracts, packed into batches within the memory budget
+# like the extracts of subregions, so usually in a single pass
+def create_tile_extraction_json(extractsdir, cutoutsdir, tiles, sourcefile):
+    os.makedirs(extractsdir, exist_ok=True)
+    os.makedirs(cutoutsdir, exist_ok=True)
+    capacity = max(osmium_extract_memory, min(memorybudget.total, virtual_memory().available))
+    for fn in extractsdir.glob(f'extracts*.json'):
+        os.remove(fn)
+    estimates = []
+    for quadkey, bbox, size in tiles:
+        memory = extract_memory_base + size * extract_memory_per_output_byte
+        extract = {'output': f'tile-{quadkey}.osm.pbf', 'bbox': list(bbox)}
+        estimates.append({'output': size, 'memory': min(osmium_extract_memory, memory), 'extract': extract})
+    write_extraction_batches(extractsdir, cutoutsdir, [(sourcefile, estimates)], capacity)
 
 # Convert pbf to shapefiles
-async def toshapefile_async(input_, output):
-    if output.is_dir():
+def shapefile_fingerprint(input_):
+    return fingerprint(file_identity(input_), shapefilecategories, shapefileexport, file_identity(osmconffile), tool_version('ogr2ogr'))
+
+# The shapefiles are written to a temporary folder, which replaces output once all categories are done
+async def toshapefile_async(input_, output, progress=None):
+    key = shapefile_fingerprint(input_)
+    if journal.done(output, key):
         return
-    try:
-        os.makedirs(output)
-        for (category, query) in shapefilecategories.items():
-            print(f"category: {category},  query: {query}, from input: {input_} to output: {output}")
-            await run_external_program_async(
-                "ogr2ogr",
-                "-oo", f"CONFIG_FILE={osmconffile}",
-                "-lco",
-                "ENCODING=UTF-8",
-                "-dialect", "SQLITE",
-                "-overwrite",
-                "-f", "ESRI Shapefile",
-                str(output / category),
-                str(input_),
-                "-progress",
-                "-sql", query)
-    except KeyboardInterrupt as e:
-        os.unlink(output)
-        raise e from None
+    tmpoutput = temporary_path(output)
+    remove_path(tmpoutput)
+    steps = len(shapefilecategories) + (shapefileexport == 'gpkg')
+    def stepprogress(step):
+        def onoutput(chunk):
+            percents = ogr_progress.findall(chunk)
+            if percents and progress:
+                progress((step + int(percents[-1]) / 100) / steps)
+        return onoutput
+    os.makedirs(tmpoutput)
+    async with memorybudget.reserve_async(ogr_memory_base + input_.stat().st_size * ogr_memory_per_input_byte):
+        await write_shapefiles_async(input_, tmpoutput, stepprogress, steps)
+    remove_path(output)
+    os.replace(tmpoutput, output)
+    journal.record(output, key)
+
+async def write_shapefiles_async(input_, tmpoutput, stepprogress, steps):
+    source = input_
+    openoptions = ["-oo", f"CONFIG_FILE={osmconffile}"]
+    if shapefileexport == 'gpkg':
+        # Decode the pbf once, then run every category query against the GeoPackage
+        source = tmpoutput / shapefileintermediate
+        print(f"Converting {input_} to {source}")
+        await run_external_program_async(
+            "ogr2ogr",
+            *openoptions,
+            "-f", "GPKG",
+            "-lco", "GEOMETRY_NAME=geometry",
+            "-lco", "SPATIAL_INDEX=NO",
+            "-gt", "65536",
+            str(source),
+            str(input_),
+            "-progress",
+            quiet=True,
+            onoutput=stepprogress(0))
+        openoptions = []
+    for step, (category, query) in enumerate(shapefilecategories.items(), steps - len(shapefilecategories)):
+        print(f"category: {category},  query: {query}, from input: {source} to output: {tmpoutput}")
+        await run_external_program_async(
+            "ogr2ogr",
+            *openoptions,
+            "-lco",
+            "ENCODING=UTF-8",
+            "-dialect", "SQLITE",
+            "-overwrite",
+            "-f", "ESRI Shapefile",
+            str(tmpoutput / category),
+            str(source),
+            "-progress",
+            "-sql", query,
+            quiet=True,
+            onoutput=stepprogress(step))
+    if source != input_:
+        os.remove(source)
 
 def stripext(path, ext): 
     path = str(path)
@@ -338,87 +1710,392 @@ def stripext(path, ext):
         raise RuntimeError(f'Expected {ext} on {path}')
     return path
 
-def getNameToIdMap(osmFile):
-    et = ET.parse(osmFile)
-    relations = et.findall("relation")
-    nameToIDMap = dict()
-    for relation in relations:
-        id = relation.get("id")
-        name = getTag(relation, 'name')
-        englishName = getTag(relation, 'name:en')
-        if name is None:
-            print(f"Warning: In {osmFile}, {id} ({englishName}) has no name")
-            continue
-        nameToIDMap[name] = id
-    return nameToIDMap
+def read_blacklist():
+    with blacklistlock:
+        return blacklistfile.is_file() and set(slurp(blacklistfile).split('\n'))
 
-def extract(extractfolder, relationsfolder, cutoutfolder, planetfile, blacklist):
-    create_extraction_json(extractfolder, relationsfolder, cutoutfolder, blacklist)
-    try:
-        osmium_extracts(extractfolder, planetfile)
-    except RetryWithUpdatedBlacklist:
-        blacklist = set(slurp(blacklistfile).split('\n'))
-        extract(extractfolder, relationsfolder, cutoutfolder, planetfile, blacklist)
+def extract(extractfolder, relationsfolders, cutoutfolder, planetfile, blacklist, sourcebbox, exclude=frozenset(), parts=()):
+    create_extraction_json(extractfolder, relationsfolders, cutoutfolder, blacklist, planetfile, sourcebbox, exclude, parts)
+    osmium_extracts(extractfolder, planetfile)
+
+# Cut the planet into the continents in one pass, so country batches need not each read the whole planet
+def presplit_planet(planetfile):
+    parts = [(continentfolder / f'{name}.osm.pbf', bbox) for name, bbox in continents.items()]
+    key = fingerprint(file_identity(planetfile), parts, tool_version('osmium'))
+    if all(journal.done(path, key) for path, _ in parts):
+        return parts
+    partial = continentfolder / 'partial'
+    ensure_dir(partial)
+    config = continentfolder / 'continents.json'
+    with open(config, 'w') as fh:
+        json.dump({'directory': str(partial), 'extracts': [{'output': path.name, 'bbox': list(bbox)} for path, bbox in parts]}, fh)
+    with memorybudget.reserve(len(parts) * osmium_extract_memory):
+        print(f"Splitting {planetfile} into {len(parts)} continents")
+        run_external_program("osmium", "extract", "--overwrite", "--strategy", "simple", "-c", str(config), str(planetfile),
+                             profileinfo={'batch': str(config)})
+    for path, _ in parts:
+        os.replace(partial / path.name, path)
+        journal.record(path, key)
+    return parts
 
 def produce_country_pbfs(blacklist, planetfile):
-    countryRelations = get_relations(overpassurl, post_body, countryosmfile)
-    get_full_regions_from_xml(countryosmfile, countryRelations, basepaths['relation'])
-    extract(basepaths['extract'], basepaths['relation'], basepaths['cutout'], planetfile, blacklist)
-
-def get_region_name_from_relative_path(path):
-    mapfile = basepaths['relation'] / path.parent / relationsmapfile
-    expected_fn = stripext(path.name, '.pbf')
-    with open(mapfile) as fh:
-        mapping = json.load(fh)
-    for id_, filename, name, name_en in mapping:
-        if filename == expected_fn:
-            return name
-    raise KeyError(f"{expected_fn} not in {mapfile}")
-
-def produce_region_pbf(regionpath, regionNameToIdMap, admin_level, blacklist, threshold):
-    if regionpath.stat().st_size < threshold:
-        return
-    relpath_from_countrycutouts = regionpath.relative_to(basepaths['cutout'])
-    relpath_dir_name = relpath_from_countrycutouts.parent
-    regionfilename = stripext(regionpath.name, '.osm.pbf')
-    regionname = get_region_name_from_relative_path(relpath_from_countrycutouts)
-    region_relations_file = Path("relations") / relpath_dir_name / f'{regionfilename}.osm'
-    regionRelationFolder = basepaths['relation'] / relpath_dir_name / regionfilename
-    regionExtractFolder = basepaths['extract'] / relpath_dir_name / regionfilename
-    region_cutouts_target_dir = basepaths['cutout'] / relpath_dir_name / regionfilename
+    with profile_stage('country fetch'):
+        countryRelations = get_relations(overpassurl, post_body, countryosmfile)
+        get_full_regions_from_xml(countryosmfile, countryRelations, basepaths['relation'])
+    parts = ()
+    if presplit:
+        with profile_stage('presplit'):
+            parts = presplit_planet(planetfile)
+    with profile_stage('country extraction'):
+        extract(basepaths['extract'], [basepaths['relation']], basepaths['cutout'], planetfile, blacklist, worldbbox, parts=parts)
 
+# Fetch the subregions of the region at relpath, from the first admin level that has any.
+# Returns that admin level, or None.
+def find_subregions(relpath, regionid, admin_level):
     for i in range(admin_level, 8, 2):
+        # Each level has its own cache file, so an empty answer for one level does not hide the next
+        region_relations_file = Path("relations") / f'{relpath}.admin{i}.osm'
         print(f"Attempting to retrieve regions for admin_level: {i}")
-        subregion_query = get_subregion_relations(regionNameToIdMap[regionname], i)
+        subregion_query = get_subregion_relations(regionid, i)
         regionRelations = get_relations(overpassurl, subregion_query, region_relations_file)
         if len(regionRelations) > 0:
             print(f"Found regions for admin level: {i}")
-            admin_level = i
             break
     else:
+        return None
+    get_full_regions_from_xml(region_relations_file, regionRelations, basepaths['relation'] / relpath)
+    return i
+
+# Subregions predicted to be far above the threshold would only be split again, so fetch their own subregions
+# right away and extract those in the same pass, skipping the intermediate cutout.
+def expand_dense_subregions(relpath, admin_level, threshold, groups, expanded):
+    groups.append((relpath, admin_level))
+    if admin_level + 2 >= 8:
+        return
+    for region in regionindex.children(relpath):
+        relationpath = Path(region['relation_file'])
+        polygon = regionindex.polygon(region['path'])
+        predicted = densitygrid.predict(polygon) if polygon is not None else None
+        if predicted is None or predicted < threshold * density_expand_factor:
+            continue
+        subrelpath = Path(region['path'])
+        found = find_subregions(subrelpath, region['id'], admin_level + 2)
+        if found is None:
+            continue
+        print(f"{subrelpath} is predicted to be {predicted / 1e6:.0f} MB, extracting its subregions directly")
+        expanded.add(relationpath)
+        expand_dense_subregions(subrelpath, found, threshold, groups, expanded)
+
+# How the cutout at regionpath is to be split: (relpath, [(relpath, admin_level), ...], expanded relation files, tiles),
+# with either subregions or, for regions without any, quadtree tiles as (quadkey, bbox, estimated size).
+# None if it is small enough, or cannot be split any further.
+def plan_region_split(regionpath, admin_level, threshold):
+    relpath = Path(stripext(regionpath.relative_to(basepaths['cutout']), '.osm.pbf'))
+    size = regionindex.cutout_size(relpath, regionpath)
+    if size < threshold:
+        return None
+    region = regionindex.get(relpath)
+    if region is None:
+        raise KeyError(f"{relpath} not in {regionindexfile}")
+    if region['tile'] is None:
+        found = find_subregions(relpath, region['id'], admin_level)
+        if found is not None:
+            groups = [(relpath, found)]
+            expanded = set()
+            if densitygrid is not None:
+                groups = []
+                expand_dense_subregions(relpath, found, threshold, groups, expanded)
+            return relpath, groups, expanded, []
+    bbox = regionindex.extent(relpath)
+    if bbox is None or min(bbox[2] - bbox[0], bbox[3] - bbox[1]) < 2 * tileminsize:
+        print(f"WARNING: {regionpath} is above the threshold, but cannot be split any further")
+        return None
+    if region['tile'] is None:
+        # The extraction polygon may reach this far beyond the relation
+        padding = 2 * polygontolerance
+        bbox = (bbox[0] - padding, bbox[1] - padding, bbox[2] + padding, bbox[3] + padding)
+    tiles = plan_tiles(bbox, size, threshold, region['tile'] or '')
+    print(f"{relpath} has no subregions, splitting it into {len(tiles)} tiles")
+    regionindex.set_tiles(relpath, [(region_key(tile_relpath(relpath, quadkey)), quadkey, tilebbox) for quadkey, tilebbox, _ in tiles])
+    return relpath, [], set(), tiles
+
+# onleaf, if given, is called with every cutout which is not split any further
+def produce_region_pbf(regionpath, admin_level, blacklist, threshold, scheduler, onleaf=None):
+    split = plan_region_split(regionpath, admin_level, threshold)
+    if split is None:
+        if onleaf:
+            onleaf(regionpath)
+        return
+    relpath, groups, expanded, tiles = split
+    if tiles:
+        create_tile_extraction_json(basepaths['extract'] / relpath, basepaths['cutout'] / relpath, tiles, regionpath)
+        osmium_extracts(basepaths['extract'] / relpath, regionpath)
+        for quadkey, _, _ in tiles:
+            tilepath = basepaths['cutout'] / f'{tile_relpath(relpath, quadkey)}.osm.pbf'
+            scheduler.submit(produce_region_pbf, tilepath, admin_level, blacklist, threshold, scheduler, onleaf)
         return
-    get_full_regions_from_xml(region_relations_file, regionRelations, regionRelationFolder)
-    extract(regionExtractFolder, regionRelationFolder, region_cutouts_target_dir, regionpath, blacklist)
-    for subregion_file in sorted([entry for entry in region_cutouts_target_dir.iterdir() if entry.is_file()]):
-        nameToIdMap = getNameToIdMap(region_relations_file)
-        produce_region_pbf(subregion_file, nameToIdMap, admin_level + 2, blacklist, threshold)
-
-async def cutouts_to_shapefiles_async():
-    processes = []
+    regionbbox = regionindex.extent(relpath)
+    relationfolders = [basepaths['relation'] / grouprelpath for grouprelpath, _ in groups]
+    extract(basepaths['extract'] / relpath, relationfolders, basepaths['cutout'] / relpath, regionpath, blacklist, regionbbox or worldbbox, expanded)
+    for grouprelpath, level in groups:
+        region_cutouts_target_dir = basepaths['cutout'] / grouprelpath
+        for subregion_file in sorted(region_cutouts_target_dir.glob('*.osm.pbf')):
+            scheduler.submit(produce_region_pbf, subregion_file, level + 2, blacklist, threshold, scheduler, onleaf)
+
+# Tasks for the queue. Together they do what the main program does, but each region split, extract batch,
+# shapefile export and coastline clip is a task of its own, which adds the tasks following from it.
+def queue_extracts(queue, extractfolder, relationsfolders, cutoutfolder, sourcefile, sourcebbox, exclude=frozenset(), parts=()):
+    create_extraction_json(extractfolder, relationsfolders, cutoutfolder, read_blacklist(), sourcefile, sourcebbox, exclude, parts)
+    queue_extract_batches(queue, extractfolder, sourcefile)
+
+# The batch files have just been written, so batches done under the same name before are run again
+def queue_extract_batches(queue, extractfolder, sourcefile):
+    plan = extract_plan(extractfolder)
+    for extractfile in sorted(extractfolder.glob('extracts*.json')):
+        queue.put('extract', extractfile, batch_source(plan, extractfile, sourcefile), priority=batch_memory(plan, extractfile), reset=True)
+
+def queue_leaf(queue, cutout):
+    if queue.settings['shapefiles']:
+        queue.put('shapefile', cutout, priority=cutout.stat().st_size)
+
+def task_countries(queue):
+    countryRelations = get_relations(overpassurl, post_body, countryosmfile)
+    get_full_regions_from_xml(countryosmfile, countryRelations, basepaths['relation'])
+    planetfile = Path(queue.settings['planet'])
+    parts = presplit_planet(planetfile) if queue.settings.get('presplit') else ()
+    queue_extracts(queue, basepaths['extract'], [basepaths['relation']], basepaths['cutout'], planetfile, worldbbox, parts=parts)
+
+# Cutouts written by this task are split again even if they were split before
+def task_extract(queue, extractfile, sourcefile):
+    extractfile = Path(extractfile)
+    if not extractfile.is_file():
+        print(f"{extractfile} is no longer part of the plan")
+        return
+    _, pending = pending_extracts(extractfile, Path(sourcefile))
+    written = {extract['output'] for extract in pending}
+    run_extract_batch(extractfile, Path(sourcefile), batch_memory(extract_plan(extractfile.parent), extractfile))
+    with open(extractfile) as fh:
+        data = json.load(fh)
+    for extract in data['extracts']:
+        cutout = Path(data['directory']) / extract['output']
+        region = regionindex.get(stripext(cutout.relative_to(basepaths['cutout']), '.osm.pbf'))
+        queue.put('split', cutout, int(region['admin_level']) + 2, priority=cutout.stat().st_size, reset=extract['output'] in written)
+
+def task_split(queue, cutout, admin_level):
+    cutout = Path(cutout)
+    split = plan_region_split(cutout, admin_level, queue.settings['threshold'])
+    if split is None:
+        queue_leaf(queue, cutout)
+        return
+    relpath, groups, expanded, tiles = split
+    if tiles:
+        create_tile_extraction_json(basepaths['extract'] / relpath, basepaths['cutout'] / relpath, tiles, cutout)
+        queue_extract_batches(queue, basepaths['extract'] / relpath, cutout)
+        return
+    relationfolders = [basepaths['relation'] / grouprelpath for grouprelpath, _ in groups]
+    queue_extracts(queue, basepaths['extract'] / relpath, relationfolders, basepaths['cutout'] / relpath, cutout, regionindex.extent(relpath) or worldbbox, expanded)
+
+def task_shapefile(queue, cutout):
+    multipath = Multipath(Path(stripext(Path(cutout).relative_to(basepaths['cutout']), '.osm.pbf')))
+    asyncio.run(toshapefile_async(multipath.cutout(), multipath.shapefolder()))
+    region = regionindex.get(multipath.relpath)
+    queue.put('clip', multipath.relpath, priority=region['vertices'] if region is not None and region['vertices'] else 0, requires='coastlines')
+
+def task_coastlines(queue):
+    (land, water) = generate_coastlines(Path(queue.settings['planet']), coastlinefolder)
+    index_shapefile(land)
+    index_shapefile(water)
+
+def task_clip(queue, relpath):
+    asyncio.run(clip_region_async(Multipath(Path(relpath)), coastlinefolder / 'land.shp', coastlinefolder / 'ocean.shp', lambda fraction: None))
+
+taskhandlers = {
+    'countries': task_countries,
+    'extract': task_extract,
+    'split': task_split,
+    'shapefile': task_shapefile,
+    'coastlines': task_coastlines,
+    'clip': task_clip,
+}
+
+def seed_queue(queue, settings, planetfile):
+    queue.seed(settings)
+    queue.put('countries', priority=math.inf)
+    if settings['shapefiles']:
+        queue.put('coastlines', priority=planetfile.stat().st_size)
+
+# Work on queued tasks with `jobs` threads until none are left to claim or waiting on other workers
+def run_queue_worker(queue, jobs):
+    def work():
+        while True:
+            task = queue.claim()
+            if task is None:
+                counts = queue.counts()
+                if not counts.get('pending') and not counts.get('running'):
+                    return
+                time.sleep(taskpoll)
+                continue
+            print(f"{queue.worker} starting {task['key']} (attempt {task['attempts'] + 1})")
+            try:
+                taskhandlers[task['kind']](queue, *json.loads(task['args']))
+            except Exception as e:
+                print(f"{queue.worker} failed {task['key']}: {e}")
+                queue.fail(task['key'], f'{type(e).__name__}: {e}')
+            else:
+                queue.done(task['key'])
+    stop = threading.Event()
+    def heartbeat():
+        while not stop.wait(tasklease / 3):
+            queue.renew()
+    threading.Thread(target=heartbeat, daemon=True).start()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            for future in [executor.submit(work) for _ in range(max(1, jobs))]:
+                future.result()
+    finally:
+        stop.set()
+    print(f"Task queue: {queue.counts()}")
+    failed = queue.failed()
+    if failed:
+        raise RuntimeError(f"{len(failed)} tasks failed, e.g. {failed[0]['key']}: {failed[0]['error']}")
+
+# Runs jobs on a fixed number of workers, largest first. A worker takes the next job as soon as it is free.
+# Each job is a (name, size, function) tuple; the function is given a progress callback and returns an awaitable.
+async def run_job_pool(jobs, workers):
+    pending = sorted(jobs, key=lambda job: job[1], reverse=True)
+    total = len(pending)
+    done = 0
+    def reporter(name):
+        reported = -1
+        def report(fraction):
+            nonlocal reported
+            percent = min(100, int(fraction * 100)) // 10 * 10
+            if percent > reported:
+                reported = percent
+                print(f"[{done}/{total}] {name}: {percent}%")
+        return report
+    async def worker():
+        nonlocal done
+        while pending:
+            name, _, job = pending.pop(0)
+            await job(reporter(name))
+            done += 1
+            print(f"[{done}/{total}] {name} done")
+    tasks = [asyncio.ensure_future(worker()) for _ in range(max(1, workers))]
+    try:
+        await asyncio.gather(*tasks)
+    except:
+        for task in tasks:
+            task.cancel()
+        raise
+
+async def cutouts_to_shapefiles_async(workers):
+    jobs = []
     for multipath in Multipath.cutoutfiles():
-        if not multipath.cutouthassubfolder():
-            processes.append(toshapefile_async(multipath.cutout(), multipath.shapefolder()))
-    threads = os.cpu_count()
-    for chunk in _chunked(processes, threads):
-        gatherer = asyncio.gather(*chunk)
-        try:
-            await gatherer
-        except:
-            gatherer.cancel()
-            raise
+        cutout = multipath.cutout()
+        if not multipath.cutouthassubfolder() and not journal.done(multipath.shapefolder(), shapefile_fingerprint(cutout)):
+            jobs.append((str(multipath.relpath), cutout.stat().st_size, functools.partial(toshapefile_async, cutout, multipath.shapefolder())))
+    await run_job_pool(jobs, workers)
+
+# Locations of the nodes in an OSM change file, and the changes which carry no location: deleted nodes, and ways and
+# relations with the objects they refer to. Those are returned as ids in the form of an osmium id file ('n1', 'w2', 'r3').
+def change_locations(changefile):
+    opener = gzip.open if str(changefile).endswith('.gz') else open
+    xs = []
+    ys = []
+    ids = set()
+    with opener(changefile, 'rb') as fh:
+        for _, element in ET.iterparse(fh):
+            if element.tag == 'node':
+                if element.get('lat') is not None:
+                    xs.append(float(element.get('lon')))
+                    ys.append(float(element.get('lat')))
+                else:
+                    ids.add(f"n{element.get('id')}")
+            elif element.tag == 'way':
+                ids.add(f"w{element.get('id')}")
+                ids.update(f"n{nd.get('ref')}" for nd in element.iter('nd'))
+            elif element.tag == 'relation':
+                ids.add(f"r{element.get('id')}")
+                ids.update(f"{member.get('type')[0]}{member.get('ref')}" for member in element.iter('member'))
+            if element.tag in ('node', 'way', 'relation'):
+                element.clear()
+    return np.array(xs), np.array(ys), ids
 
-def _chunked(list_, chunk_size):
-    return [list_[i:i + chunk_size] for i in range(0, len(list_), chunk_size)]
+def points_in_bbox(bbox, xs, ys):
+    xmin, ymin, xmax, ymax = bbox
+    return np.nonzero((xs >= xmin) & (xs <= xmax) & (ys >= ymin) & (ys <= ymax))[0]
+
+def touched_by_changes(polygon, xs, ys):
+    if polygon.bbox is None:
+        return False
+    return any(polygon.contains(xs[i], ys[i]) for i in points_in_bbox(polygon.bbox, xs, ys))
+
+# Whether the cutout holds any of the objects in idfile, which osmium getid copies out of it
+def cutout_contains(multipath, idfile):
+    cutout = multipath.cutout()
+    found = cutout.with_name(cutout.name + '.found.tmp')
+    # getid returns 1 when not all of the objects are found
+    run_external_program('osmium', 'getid', '--overwrite', '-i', str(idfile), '-f', 'opl', '-o', str(found), str(cutout),
+                         onerr=lambda code, stdout: code == 1, quiet=True)
+    contains = found.is_file() and found.stat().st_size > 0
+    remove_path(found)
+    return contains
+
+# Apply the changes to the cutout, then clip it to the polygon it was extracted with, to drop everything that belongs elsewhere
+def update_cutout(multipath, changefiles):
+    cutout = multipath.cutout()
+    changed = cutout.with_name(cutout.name + '.changed.tmp')
+    clipped = cutout.with_name(cutout.name + '.clipped.tmp')
+    print(f"Updating {cutout}")
+    run_external_program('osmium', 'apply-changes', '--overwrite', '-f', 'pbf', '-o', str(changed), str(cutout), *map(str, changefiles), quiet=True)
+    tilebbox = multipath.tilebbox()
+    # Simplifying reserves memory of its own
+    polygon = extraction_polygon(multipath.relation())['file_name']
+    with memorybudget.reserve(osmium_extract_memory):
+        run_external_program('osmium', 'extract', '--overwrite', '--strategy', 'simple', '-p', polygon, '-f', 'pbf', '-o', str(clipped), str(changed), quiet=True)
+        if tilebbox is not None:
+            os.replace(clipped, changed)
+            run_external_program('osmium', 'extract', '--overwrite', '--strategy', 'simple', '-b', ','.join(map(str, tilebbox)), '-f', 'pbf', '-o', str(clipped), str(changed), quiet=True)
+    os.replace(clipped, cutout)
+    os.remove(changed)
+    regionindex.set_cutout_size(multipath.relpath, cutout.stat().st_size)
+
+def update_cutouts(changefiles, jobs):
+    xs, ys = np.array([]), np.array([])
+    ids = set()
+    for changefile in changefiles:
+        changexs, changeys, changeids = change_locations(changefile)
+        xs, ys = np.concatenate([xs, changexs]), np.concatenate([ys, changeys])
+        ids |= changeids
+    print(f"{len(xs)} changed locations and {len(ids)} objects without location in {len(changefiles)} change files")
+    touched = []
+    others = []
+    # Only leaves are exported, so cutouts which were split further are left as they are
+    for multipath in Multipath.cutoutfiles():
+        if multipath.cutouthassubfolder():
+            continue
+        bbox = regionindex.extent(multipath.relpath)
+        polygon = None
+        if bbox is None or len(points_in_bbox(bbox, xs, ys)):
+            polygon = regionindex.polygon(multipath.relpath)
+        if polygon is not None and touched_by_changes(polygon, xs, ys):
+            touched.append(multipath)
+        else:
+            others.append(multipath)
+    # Changes without location are looked up by id in the cutouts as they are before the update
+    if ids and others:
+        idfile = Path('update-ids.txt')
+        with open(idfile, 'w') as fh:
+            fh.write('\n'.join(sorted(ids)) + '\n')
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            touched += [multipath for multipath, contains in zip(others, executor.map(lambda multipath: cutout_contains(multipath, idfile), others)) if contains]
+        os.remove(idfile)
+    print(f"{len(touched)} cutouts are touched by the changes")
+    scheduler = RegionScheduler(jobs)
+    for multipath in touched:
+        scheduler.submit(update_cutout, multipath, changefiles)
+    scheduler.wait()
 
 def generate_coastlines(planetfile, targetdir):
     def handler(code, text):
@@ -430,14 +2107,34 @@ def generate_coastlines(planetfile, targetdir):
     print("Generating coastlines")
     ensure_dir(targetdir)
     both = targetdir / 'both.db'
-    if not both.is_file():
-        run_external_program('osmcoastline', '--output-polygons=both', '-o', str(both), str(planetfile), onerr=handler)
+    key = fingerprint(file_identity(planetfile), tool_version('osmcoastline'))
+    if not journal.done(both, key):
+        tmpboth = temporary_path(both)
+        remove_path(tmpboth)
+        with memorybudget.reserve(coastline_memory):
+            run_external_program('osmcoastline', '--output-polygons=both', '-o', str(tmpboth), str(planetfile), onerr=handler)
+        os.replace(tmpboth, both)
+        journal.record(both, key)
+    land = targetdir / 'land.shp'
+    water = targetdir / 'ocean.shp'
+    tmpdir = temporary_path(targetdir / 'layers')
+    key = fingerprint(file_identity(both), tool_version('ogr2ogr'))
+    for layer, shape in (('land_polygons', land), ('water_polygons', water)):
+        if journal.done(shape, key):
+            continue
+        remove_path(tmpdir)
+        ensure_dir(tmpdir)
+        run_external_program('ogr2ogr', '-f', 'ESRI Shapefile', str(tmpdir / shape.name), str(both), layer)
+        replace_shapefile(tmpdir / shape.name, shape)
+        journal.record(shape, key)
+    return (land, water)
+
+# Change files do not update the planet, so updated regions are clipped with the coastlines of the last full run
+def existing_coastlines(targetdir):
     land = targetdir / 'land.shp'
     water = targetdir / 'ocean.shp'
-    if not land.is_file():
-        run_external_program('ogr2ogr', '-f', 'ESRI Shapefile', str(land), str(both), 'land_polygons')
-    if not water.is_file():
-        run_external_program('ogr2ogr', '-f', 'ESRI Shapefile', str(water), str(both), 'water_polygons')
+    if not land.is_file() or not water.is_file():
+        raise RuntimeError(f"{land} and {water} from a full run are required to clip the updated regions")
     return (land, water)
 
 def get_extent(multipath, padding=None):
@@ -455,51 +2152,236 @@ def get_extent(multipath, padding=None):
         ymax = pad(ymax, padding)
     return xmin, ymin, xmax, ymax
 
-def clip_region_coastlines(land, water):
+# Padded extent of a region, from the region index when it is known there
+def region_extent(multipath, padding):
+    bbox = regionindex.extent(multipath.relpath)
+    if bbox is None:
+        return get_extent(multipath, padding)
+    xmin, ymin, xmax, ymax = bbox
+    return str(xmin - padding), str(ymin - padding), str(xmax + padding), str(ymax + padding)
+
+# A .qix index lets ogr2ogr -spat read only the coastline polygons near a region
+def index_shapefile(shapefile):
+    if not shapefile.with_suffix('.qix').is_file():
+        run_external_program('ogrinfo', str(shapefile), '-sql', f'CREATE SPATIAL INDEX ON "{shapefile.stem}"', quiet=True)
+
+def clip_fingerprint(multipath, coastlines):
+    return fingerprint(file_identity(multipath.relation()), multipath.tilebbox(), file_identity(coastlines), tool_version('ogr2ogr'))
+
+def clip_done(multipath, land, water):
+    return (journal.done(multipath.landshape(), clip_fingerprint(multipath, land))
+            and journal.done(multipath.oceanshape(), clip_fingerprint(multipath, water)))
+
+# The clip polygon for ogr2ogr -clipsrc, written from the region index as a one-row CSV with a WKT column
+def write_clip_polygon(multipath):
+    multipolygons = multipath.multipolygons()
+    geometry = regionindex.geometry(multipath.relpath)
+    if geometry is None:
+        raise RuntimeError(f'No geometry for {multipath.relpath} in {regionindexfile}')
+    key = fingerprint(geometry)
+    if journal.done(multipolygons, key):
+        return multipolygons
+    ensure_dir(multipath.csv())
+    tmpcsv = temporary_path(multipolygons)
+    with open(tmpcsv, 'w', encoding='UTF-8') as fh:
+        fh.write(f'WKT\n"{geometry}"\n')
+    os.replace(tmpcsv, multipolygons)
+    journal.record(multipolygons, key)
+    return multipolygons
+
+async def clip_region_async(multipath, land, water, progress):
+    multipolygons = write_clip_polygon(multipath)
+    extent = region_extent(multipath, 0.1)
+    tilebbox = multipath.tilebbox()
+    tileclip = ['-clipdst', *map(str, tilebbox)] if tilebbox is not None else []
+    tmpdir = temporary_path(multipath.shapefolder() / 'clip')
+    for i, (coastlines, shape) in enumerate(((land, multipath.landshape()), (water, multipath.oceanshape()))):
+        key = clip_fingerprint(multipath, coastlines)
+        if not journal.done(shape, key):
+            remove_path(tmpdir)
+            ensure_dir(tmpdir)
+            async with memorybudget.reserve_async(ogr_memory_base):
+                await run_external_program_async('ogr2ogr', '-skipfailures', '-spat', *extent, '-clipsrc', str(multipolygons), *tileclip, str(tmpdir / shape.name), str(coastlines), quiet=True)
+            replace_shapefile(tmpdir / shape.name, shape)
+            journal.record(shape, key)
+        progress((i + 1) / 2)
+    remove_path(tmpdir)
+
+async def clip_region_coastlines_async(land, water, workers):
     print("Clipping region coastlines")
+    index_shapefile(land)
+    index_shapefile(water)
+    jobs = []
     for multipath in Multipath.shapefolders():
-        multipolygons = multipath.multipolygons()
-        if not multipolygons.is_file():
-            ensure_dir(multipath.csv().parent)
-            run_external_program('ogr2ogr', '-f', 'CSV', str(multipath.csv()), str(multipath.relation()), '-lco', 'GEOMETRY=AS_WKT', quiet=True)
-        outland = multipath.landshape()
-        outwater = multipath.oceanshape()
-        if not outland.is_file() or not outwater.is_file():
-            print(str(multipath.relpath))
-            extent = get_extent(multipath, 0.1)
-        if not outland.is_file():
-            run_external_program('ogr2ogr', '-skipfailures', '-spat', *extent, '-clipsrc', str(multipolygons), str(outland), str(land), quiet=True)
-        if not outwater.is_file():
-            run_external_program('ogr2ogr', '-skipfailures', '-spat', *extent, '-clipsrc', str(multipolygons), str(outwater), str(water), quiet=True)
+        if clip_done(multipath, land, water):
+            continue
+        region = regionindex.get(multipath.relpath)
+        size = region['vertices'] if region is not None and region['vertices'] else 0
+        jobs.append((str(multipath.relpath), size, functools.partial(clip_region_async, multipath, land, water)))
+    await run_job_pool(jobs, workers)
+
+# Runs shapefile export and coastline clipping alongside the region splits, on the splits' scheduler. A cutout is
+# exported as soon as it is known to be a leaf, and clipped once both its shapefiles and the coastlines exist.
+# The coastlines are generated in a thread of their own, from the start.
+class Pipeline:
+    def __init__(self, planetfile, scheduler):
+        self.scheduler = scheduler
+        self.lock = threading.Lock()
+        self.coastlines = None
+        self.waiting = []
+        self.error = None
+        self.thread = threading.Thread(target=self.generate_coastlines, args=(planetfile,), daemon=True)
+        self.thread.start()
+    def generate_coastlines(self, planetfile):
+        try:
+            (land, water) = generate_coastlines(planetfile, coastlinefolder)
+            index_shapefile(land)
+            index_shapefile(water)
+        except BaseException as e:
+            self.error = e
+            return
+        with self.lock:
+            self.coastlines = (land, water)
+            waiting, self.waiting = self.waiting, []
+        for multipath in waiting:
+            self.scheduler.submit(self.clip, multipath)
+    def leaf(self, cutout):
+        multipath = Multipath(Path(stripext(cutout.relative_to(basepaths['cutout']), '.osm.pbf')))
+        self.scheduler.submit(self.export, multipath)
+    def export(self, multipath):
+        asyncio.run(toshapefile_async(multipath.cutout(), multipath.shapefolder()))
+        with self.lock:
+            if self.coastlines is None:
+                self.waiting.append(multipath)
+                return
+        self.clip(multipath)
+    def clip(self, multipath):
+        land, water = self.coastlines
+        asyncio.run(clip_region_async(multipath, land, water, lambda fraction: None))
+    # The coastlines may still submit clips, so they are waited for before the scheduler
+    def wait(self):
+        self.thread.join()
+        self.scheduler.wait()
+        if self.error is not None:
+            raise self.error
 
 if __name__ == '__main__':
+    # Shapefile export and clipping start subprocesses from asyncio in worker threads, which needs the child watcher of 3.8
+    if sys.version_info < (3, 8):
+        sys.exit('countrymaker.py needs Python 3.8 or later')
     parser = argparse.ArgumentParser(description='Split the planet file')
     parser.add_argument('--planet-source', dest='sourcefile', default='planet-latest.osm.pbf', help='Path to the planet file you wish to split')
     parser.add_argument('--split-treshold', dest='threshold', type=int, default='150000000', help='Maximum size of pbf files (in bytes) after split')
     parser.add_argument('--overpass-server', dest='overpass', default='https://overpass-api.de/api/interpreter', help='Overpass server to use, should have as high usage limit as possible')
+    parser.add_argument('--overpass-concurrency', dest='overpassconcurrency', type=int, default=overpassconcurrency, help='Number of overpass requests to run in parallel')
+    parser.add_argument('--overpass-retries', dest='overpassretries', type=int, default=overpassretries, help='Number of times to retry an overpass request when the server is busy')
+    parser.add_argument('--offline-boundaries', dest='offline', action='store_true', help='Derive the admin hierarchy and region polygons from the planet file instead of querying overpass')
+    parser.add_argument('--density-grid', dest='densitygrid', default=None, help='Path to a node density grid (.npz) used to predict region sizes; built from the planet file if missing')
+    parser.add_argument('--update', dest='changefiles', nargs='+', default=None, help='OSM change files (.osc.gz) to apply to the existing cutouts instead of splitting the planet again')
     parser.add_argument('--shapefile-queries', dest='shplist', default='shapefiles.json', help='a file containing all desired output shapefiles with sqlite queries, given in json format')
+    parser.add_argument('--shapefile-export', dest='shapefileexport', choices=['direct', 'gpkg'], default=shapefileexport, help='direct: read the pbf once per shapefile; gpkg: convert each pbf to a GeoPackage once and query that')
     parser.add_argument('--generate-shapefiles', dest='shapefile_creation', default='no', help='set to yes if you want to create shapefiles')
     parser.add_argument('--workingdir', dest='workingdir', default='', help='Path to the working directory where the planet file is found and the output should be')
+    parser.add_argument('--profile', dest='profile', action='store_true', help='Write a JSON report of time, CPU, memory and I/O per stage, child process and overpass request')
+    parser.add_argument('--polygon-tolerance', dest='polygontolerance', type=float, default=polygontolerance, help='Simplify extraction polygons within this many degrees, after enlarging them by twice as much; 0 uses the full relations')
+    parser.add_argument('--pipeline', dest='pipeline', action='store_true', help='With --generate-shapefiles yes: export and clip each cutout as soon as it is final, and generate coastlines alongside the splits')
+    parser.add_argument('--presplit', dest='presplit', action='store_true', help='Cut the planet into overlapping continents first and extract each country from the smallest one containing it')
+    parser.add_argument('--queue', dest='queue', default=None, help='Split through a task queue in this SQLite file in the working directory, which must be on storage shared by all workers; the first process seeds it')
+    parser.add_argument('--worker', dest='worker', action='store_true', help='Only work on the tasks of an existing --queue, with the settings it was seeded with')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=os.cpu_count(), help='Maximum number of region splits, shapefile exports and coastline clips to run at the same time')
+    parser.add_argument('--memory-budget', dest='memorybudget', type=int, default=virtual_memory().total, help='Total memory (in bytes) the concurrently running osmium extracts, polygon simplifications, shapefile exports, coastline generation and clipping may use')
     args = parser.parse_args()
     planetfile = Path(args.sourcefile)
     threshold = args.threshold
+    memorybudget = MemoryBudget(args.memorybudget)
     overpassurl = args.overpass
+    overpassconcurrency = args.overpassconcurrency
+    overpassretries = args.overpassretries
     working_dir = Path(args.workingdir)
     osmconffile = osmconffile.resolve()
     os.chdir(working_dir)
     shapefile_queries = Path(args.shplist).read_text()
     shapefilecategories.update(json.loads(shapefile_queries))
+    regionindex = RegionIndex(regionindexfile)
+    journal = Journal(journalfile)
+    shapefileexport = args.shapefileexport
+    presplit = args.presplit
+    polygontolerance = args.polygontolerance
+
+    if args.profile:
+        profiler = Profiler()
+    try:
+        if args.queue:
+            queue = TaskQueue(Path(args.queue))
+            if args.worker:
+                settings = queue.load_settings()
+            else:
+                settings = {
+                    'planet': str(planetfile),
+                    'threshold': threshold,
+                    'shapefiles': args.shapefile_creation == 'yes',
+                    'shapefileexport': shapefileexport,
+                    'overpass': overpassurl,
+                    'offline': args.offline,
+                    'densitygrid': args.densitygrid,
+                    'presplit': args.presplit,
+                    'polygontolerance': polygontolerance,
+                }
+            # Workers take their settings from the queue, so that all of them split the same way
+            planetfile = Path(settings['planet'])
+            overpassurl = settings['overpass']
+            shapefileexport = settings['shapefileexport']
+            polygontolerance = settings.get('polygontolerance', polygontolerance)
+            if not planetfile.is_file():
+                raise RuntimeError(f"{planetfile.resolve()} is required. You may pass a different path as an argument to this script.")
+            if settings['offline']:
+                with profile_stage('boundary index'):
+                    overpassclients[overpassurl] = BoundaryIndex.load(boundaryindexfile, planetfile)
+            if settings['densitygrid']:
+                with profile_stage('density grid'):
+                    densitygrid = DensityGrid.load(Path(settings['densitygrid']), planetfile)
+            if not args.worker:
+                seed_queue(queue, settings, planetfile)
+            with profile_stage('queue'):
+                run_queue_worker(queue, args.jobs)
+            quit()
+        if args.changefiles:
+            with profile_stage('update'):
+                update_cutouts([Path(changefile).resolve() for changefile in args.changefiles], args.jobs)
+        else:
+            if not planetfile.is_file():
+                raise RuntimeError(f"{planetfile.resolve()} is required. You may pass a different path as an argument to this script.")
+            if args.offline:
+                with profile_stage('boundary index'):
+                    overpassclients[overpassurl] = BoundaryIndex.load(boundaryindexfile, planetfile)
+            if args.densitygrid:
+                with profile_stage('density grid'):
+                    densitygrid = DensityGrid.load(Path(args.densitygrid), planetfile)
+            blacklist = read_blacklist()
+            scheduler = RegionScheduler(args.jobs)
+            pipeline = None
+            if args.pipeline and args.shapefile_creation == 'yes':
+                pipeline = Pipeline(planetfile, scheduler)
+            produce_country_pbfs(blacklist, planetfile)
+            with profile_stage('pipeline' if pipeline else 'region splits'):
+                for relationfile in sorted(basepaths['cutout'].glob('*.osm.pbf')):
+                    scheduler.submit(produce_region_pbf, relationfile, 4, blacklist, threshold, scheduler, pipeline and pipeline.leaf)
+                if pipeline:
+                    pipeline.wait()
+                else:
+                    scheduler.wait()
 
-    if not planetfile.is_file():
-        raise RuntimeError(f"{planetfile.resolve()} is required. You may pass a different path as an argument to this script.")
-    blacklist = blacklistfile.is_file() and set(slurp(blacklistfile).split('\n'))
-    produce_country_pbfs(blacklist, planetfile)
-    nameToIdMap = getNameToIdMap(countryosmfile)
-    for relationfile in sorted([entry for entry in basepaths['cutout'].iterdir() if entry.is_file()]):
-        produce_region_pbf(relationfile, nameToIdMap, 4, blacklist, threshold)
-
-    if args.shapefile_creation != 'yes':
-        quit()
-    asyncio.run(cutouts_to_shapefiles_async())
-    (land, water) = generate_coastlines(planetfile, coastlinefolder)
-    clip_region_coastlines(land, water)
+        if args.shapefile_creation != 'yes':
+            quit()
+        with profile_stage('shapefiles'):
+            asyncio.run(cutouts_to_shapefiles_async(args.jobs))
+        with profile_stage('coastlines'):
+            if args.changefiles:
+                (land, water) = existing_coastlines(coastlinefolder)
+            else:
+                (land, water) = generate_coastlines(planetfile, coastlinefolder)
+        with profile_stage('clipping'):
+            asyncio.run(clip_region_coastlines_async(land, water, args.jobs))
+    finally:
+        if profiler is not None:
+            profiler.write(Path(time.strftime('profile-%Y%m%d-%H%M%S.json', time.localtime(profiler.started))))